@@ -0,0 +1,17 @@
+#!/bin/bash
+# Let the db-replica service stream from the primary as the replicator
+# role, which logs in with DB_PASSWORD from the compose network only.
+# Runs when the Postgres data directory is initialized. For a data
+# directory created before replication was set up, run it by hand:
+#   docker-compose exec db bash /docker-entrypoint-initdb.d/replication.sh
+set -e
+PGDATA=${PGDATA:-/var/lib/postgresql/data}
+if ! grep -q '^host replication replicator ' "$PGDATA/pg_hba.conf"; then
+    echo "host replication replicator samenet md5" >> "$PGDATA/pg_hba.conf"
+fi
+psql -v ON_ERROR_STOP=1 -U postgres -v password="$DB_PASSWORD" <<'SQL'
+SELECT 'CREATE ROLE replicator WITH REPLICATION LOGIN'
+WHERE NOT EXISTS (SELECT FROM pg_roles WHERE rolname = 'replicator') \gexec
+ALTER ROLE replicator WITH PASSWORD :'password';
+SELECT pg_reload_conf();
+SQL
@@ -0,0 +1,22 @@
+#!/bin/bash
+# Start a hot standby of the db service, cloning it on the first start.
+set -e
+if [ ! -s "$PGDATA/PG_VERSION" ]; then
+    attempts=0
+    until PGPASSWORD="$DB_PASSWORD" pg_basebackup -h db -U replicator \
+            -D "$PGDATA" -R -X stream; do
+        attempts=$((attempts + 1))
+        if [ "$attempts" -ge 120 ]; then
+            echo "The primary does not accept replication connections."
+            echo "If the database volume was created before replication was"
+            echo "set up, run on the primary:"
+            echo "  docker-compose exec db bash" \
+                 "/docker-entrypoint-initdb.d/replication.sh"
+            exit 1
+        fi
+        echo "Waiting for the primary..."
+        sleep 1
+    done
+    chmod 700 "$PGDATA"
+fi
+exec postgres -c hot_standby=on
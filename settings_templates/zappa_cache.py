@@ -0,0 +1,28 @@
+"""Redis cache, generated by setup.py.
+
+The cache is shared by all Lambda containers and also holds the sessions,
+which are backed by the database in case Redis is unavailable.
+"""
+from decouple import config
+
+if config('DJANGO_ENV', default='').startswith('aws'):
+    REDIS_HOST = config('AWS_REDIS_HOST', default='')
+else:
+    REDIS_HOST = config('REDIS_HOST', default='')
+
+if REDIS_HOST:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django_redis.cache.RedisCache',
+            'LOCATION': 'redis://{}:6379/0'.format(REDIS_HOST),
+            # The settings are run in the namespace of <project>.settings.
+            'KEY_PREFIX': __name__.split('.')[0],
+            'OPTIONS': {
+                'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+                'SOCKET_CONNECT_TIMEOUT': 2,
+                'SOCKET_TIMEOUT': 2,
+            },
+        },
+    }
+    DJANGO_REDIS_IGNORE_EXCEPTIONS = True
+    SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
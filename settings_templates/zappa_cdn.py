@@ -0,0 +1,14 @@
+"""CloudFront static files, generated by setup.py.
+
+Static files are served from the CloudFront domain on AWS, and the hashed
+names of the manifest storage are cached for a year.
+"""
+from decouple import config
+
+AWS_CLOUDFRONT_DOMAIN = config('AWS_CLOUDFRONT_DOMAIN', default='')
+if (AWS_CLOUDFRONT_DOMAIN and
+        config('DJANGO_ENV', default='').startswith('aws')):
+    STATIC_PREFIX = globals().get('AWS_S3_KEY_PREFIX_STATIC', '').strip('/')
+    AWS_S3_PUBLIC_URL_STATIC = STATIC_URL = 'https://{}/{}'.format(
+        AWS_CLOUDFRONT_DOMAIN, STATIC_PREFIX + '/' if STATIC_PREFIX else '')
+    AWS_S3_MAX_AGE_SECONDS_CACHED_STATIC = 60 * 60 * 24 * 365
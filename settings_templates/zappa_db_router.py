@@ -0,0 +1,77 @@
+"""Read replica database router, generated by setup.py.
+
+Reads go to a random replica. A replica that cannot be connected to is
+left out for a minute, and reads fall back to the primary when no replica
+is left. After a write, the reads of the same request and of the user's
+requests in the next REPLICA_PIN_SECONDS go to the primary, so users read
+their own writes.
+"""
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.db import connections
+from django.db.utils import OperationalError
+
+state = threading.local()
+unhealthy = {}
+
+
+def healthy(alias):
+    """Check that a replica accepts connections."""
+    if unhealthy.get(alias, 0) > time.monotonic():
+        return False
+    try:
+        connections[alias].ensure_connection()
+    except OperationalError:
+        unhealthy[alias] = time.monotonic() + 60
+        return False
+    return True
+
+
+class ReplicaRouter:
+    """Send reads to the replicas and everything else to the primary."""
+
+    def db_for_read(self, model, **hints):
+        if getattr(state, 'pinned', False):
+            return 'default'
+        replicas = [alias for alias in settings.DATABASES
+                    if alias.startswith('replica')]
+        random.shuffle(replicas)
+        for alias in replicas:
+            if healthy(alias):
+                return alias
+        return 'default'
+
+    def db_for_write(self, model, **hints):
+        state.pinned = state.wrote = True
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == 'default'
+
+
+class ReplicaPinMiddleware:
+    """Pin the reads of a user to the primary for a while after a write."""
+
+    cookie = 'replica_pin'
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        state.pinned = self.cookie in request.COOKIES
+        state.wrote = False
+        try:
+            response = self.get_response(request)
+            if state.wrote:
+                response.set_cookie(
+                    self.cookie, '1', max_age=settings.REPLICA_PIN_SECONDS,
+                    httponly=True)
+            return response
+        finally:
+            state.pinned = state.wrote = False
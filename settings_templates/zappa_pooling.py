@@ -0,0 +1,17 @@
+"""Connection pooling, generated by setup.py.
+
+Django keeps its connection between invocations of a Lambda container and
+the pooler shares the Postgres connections between containers. Transaction
+pooling cannot keep server side cursors open.
+"""
+from decouple import config
+
+if config('DJANGO_ENV', default='').startswith('aws'):
+    DATABASES['default']['HOST'] = config(  # noqa: F821
+        'AWS_RDS_PROXY_HOST', default=DATABASES['default']['HOST'])  # noqa
+else:
+    DATABASES['default']['HOST'] = config(  # noqa: F821
+        'DB_POOL_HOST', default=DATABASES['default']['HOST'])  # noqa
+DATABASES['default']['CONN_MAX_AGE'] = config(  # noqa: F821
+    'DB_CONN_MAX_AGE', default=300, cast=int)
+DATABASES['default']['DISABLE_SERVER_SIDE_CURSORS'] = True  # noqa: F821
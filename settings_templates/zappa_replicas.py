@@ -0,0 +1,23 @@
+"""Read replicas, generated by setup.py.
+
+Each replica host becomes a replica<N> database that mirrors the primary
+in tests. Reads are routed by the project's db_router module.
+"""
+from decouple import config
+
+if config('DJANGO_ENV', default='').startswith('aws'):
+    REPLICA_HOSTS = config('AWS_RDS_REPLICA_HOSTS', default='')
+else:
+    REPLICA_HOSTS = config('DB_REPLICA_HOSTS', default='')
+
+for number, host in enumerate(filter(None, REPLICA_HOSTS.split(','))):
+    DATABASES['replica{}'.format(number + 1)] = dict(  # noqa: F821
+        DATABASES['default'], HOST=host,  # noqa: F821
+        TEST={'MIRROR': 'default'})
+
+# The settings are run in the namespace of <project>.settings.
+DB_ROUTER = __name__.split('.')[0] + '.db_router'
+DATABASE_ROUTERS = [DB_ROUTER + '.ReplicaRouter']
+MIDDLEWARE = [DB_ROUTER + '.ReplicaPinMiddleware'] + list(
+    MIDDLEWARE)  # noqa: F821
+REPLICA_PIN_SECONDS = config('DB_REPLICA_PIN_SECONDS', default=5, cast=int)
@@ -4,23 +4,52 @@ Create the Zappa settings file, create a new Django project and build
 the Docker images.
 
 """
+import base64
+import fnmatch
+import hashlib
+import heapq
+import io
+import ipaddress
 import json
+import math
+import os
+import mimetypes
 import random
 import re
+import socket
 import string
 import subprocess
+import sys
+import tarfile
+import threading
 import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager, ExitStack
 from pathlib import Path
-from urllib.parse import urlparse
 
 import boto3
 import botocore
+import botocore.config
+import botocore.exceptions
 import click
 import docker
 import stringcase
-from troposphere import ec2, GetAtt, Output, Ref, Tags, Template
-from troposphere.rds import DBInstance, DBSubnetGroup
-from troposphere.s3 import Bucket, CorsConfiguration, CorsRules, PublicRead
+from troposphere import ec2, GetAtt, Join, Output, Ref, Tags, Template
+from troposphere.rds import (
+    AuthFormat, ConnectionPoolConfigurationInfoFormat, DBInstance,
+    DBParameterGroup, DBProxy, DBProxyTargetGroup, DBSubnetGroup
+)
+from troposphere.secretsmanager import Secret
+from troposphere.elasticache import CacheCluster
+from troposphere.elasticache import SubnetGroup as CacheSubnetGroup
+from troposphere.cloudfront import (
+    CloudFrontOriginAccessIdentity, CloudFrontOriginAccessIdentityConfig,
+    DefaultCacheBehavior, Distribution, DistributionConfig, ForwardedValues,
+    Origin, S3OriginConfig
+)
+from troposphere.s3 import (
+    Bucket, BucketPolicy, CorsConfiguration, CorsRules, PublicRead
+)
 from troposphere.iam import Policy as IAM_Policy
 from troposphere.iam import Role as IAM_Role
 from troposphere.iam import InstanceProfile as IAM_InstanceProfile
@@ -29,6 +58,315 @@ from awacs.sts import AssumeRole
 
 TEMPLATE = 'https://gitlab.com/newman99/django-split-settings-project-template/-/archive/master/django-split-settings-project-template-master.zip'  # noqa
 
+# Journal of finished setup steps, used to resume a failed run.
+STATE_FILE = '.zappa_setup.json'
+
+# Shared values of a batch run, such as the password of the shared RDS
+# instance, and the log each project of a batch writes to its directory.
+BATCH_FILE = '.zappa_batch.json'
+BATCH_LOG = '.zappa_batch.log'
+
+# Host ports published by the compose files, each set by a variable. The
+# projects of a batch run at the same time, so each gets a compose project
+# and ports of its own from BATCH_PORT_BASE on, see compose_environment().
+COMPOSE_PORTS = (
+    ('DB_HOST_PORT', 5432),
+    ('DB_REPLICA_HOST_PORT', 5433),
+    ('PGBOUNCER_HOST_PORT', 6432),
+    ('REDIS_HOST_PORT', 6379),
+    ('WEB_HOST_PORT', 8000),
+)
+COMPOSE_VARIABLES = ('COMPOSE_PROJECT_NAME',) + tuple(
+    variable for variable, port in COMPOSE_PORTS)
+BATCH_PORT_BASE = 20000
+
+# Most keys a single S3 DeleteObjects request takes.
+S3_DELETE_BATCH = 1000
+
+# Label holding the fingerprint of the inputs a web image was built from.
+IMAGE_FINGERPRINT_LABEL = 'zappa-django.fingerprint'
+
+# Docker volume holding the pip cache and the wheelhouses.
+PIP_CACHE_VOLUME = 'zappa_pip_cache'
+PIP_CACHE_DIR = '/root/.cache/pip'
+
+# Runs a batch of bootstrap commands inside the Zappa handler, see
+# run_bootstrap(). Results are printed after BOOTSTRAP_MARKER because the
+# log tail is the only output of a raw command.
+BOOTSTRAP_MARKER = 'ZAPPA_BOOTSTRAP_RESULTS '
+BOOTSTRAP_SCRIPT = '''
+import io, json, sys, time, traceback
+from django.core import management
+results = []
+for kind, command in json.loads({commands}):
+    output = io.StringIO()
+    start = time.time()
+    error = None
+    stdout, sys.stdout = sys.stdout, output
+    try:
+        if kind == 'manage':
+            management.call_command(*command.split())
+        else:
+            exec(command, {{}})
+    except Exception:
+        error = traceback.format_exc().strip().splitlines()[-1]
+    finally:
+        sys.stdout = stdout
+    results.append({{
+        'kind': kind,
+        'command': command if kind == 'manage' else 'python snippet',
+        'ok': error is None,
+        'error': error,
+        'seconds': time.time() - start,
+        'output': output.getvalue()[-200:],
+    }})
+    if error:
+        break
+print({marker!r} + json.dumps(results))
+'''
+SUPERUSER_SNIPPET = '''
+from django.contrib.auth import get_user_model
+User = get_user_model()
+if not User.objects.filter(username={username}).exists():
+    User.objects.create_superuser({username}, {email}, {password})
+'''
+# Creates the project's database on an RDS instance shared by a batch,
+# see batch. It connects to the postgres database, as its own does not
+# exist yet.
+CREATE_DATABASE_SNIPPET = '''
+import psycopg2
+from django.conf import settings
+db = settings.DATABASES['default']
+connection = psycopg2.connect(
+    host=db['HOST'], port=db['PORT'] or 5432, user=db['USER'],
+    password=db['PASSWORD'], dbname='postgres')
+connection.autocommit = True
+cursor = connection.cursor()
+cursor.execute('SELECT 1 FROM pg_database WHERE datname = %s', [db['NAME']])
+if not cursor.fetchone():
+    cursor.execute('CREATE DATABASE "{}"'.format(db['NAME']))
+connection.close()
+'''
+
+# Imports like a Zappa cold start and prints the time of each import in
+# the format of -X importtime, which the python3.6 runtime does not have.
+# split_settings compiles the settings components instead of importing
+# them, so its include() is timed as well and each component shows up
+# under the settings module as <project>.settings/<component path>.
+IMPORTTIME_FILE = '.zappa_importtime.json'
+IMPORTTIME_SCRIPT = '''
+import importlib.machinery, os, sys, time
+
+LOADERS = (importlib.machinery.SourceFileLoader,
+           importlib.machinery.SourcelessFileLoader,
+           importlib.machinery.ExtensionFileLoader)
+stack = []
+
+
+class ImportTimer:
+    def find_spec(self, name, path=None, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, 'find_spec'):
+                continue
+            spec = finder.find_spec(name, path, target)
+            if spec is not None:
+                break
+        else:
+            return None
+        if isinstance(spec.loader, LOADERS):
+            spec.loader.exec_module = timed(name, spec.loader.exec_module)
+        return spec
+
+
+def timed_include(*args, **kwargs):
+    scope = kwargs.pop('scope', None) or sys._getframe(1).f_globals
+    settings_dir = os.path.dirname(scope['__file__'])
+    including_dir = os.path.dirname(
+        scope.get('__included_file__', scope['__file__']))
+    for conf_file in args:
+        component = os.path.relpath(
+            os.path.join(including_dir, conf_file), settings_dir)
+        timed('{{}}/{{}}'.format(scope['__name__'], component), include)(
+            conf_file, scope=scope)
+
+
+def timed(name, function):
+    def exec_timed(*args, **kwargs):
+        stack.append(0)
+        start = time.perf_counter()
+        try:
+            function(*args, **kwargs)
+        finally:
+            cumulative = int((time.perf_counter() - start) * 1000000)
+            children = stack.pop()
+            if stack:
+                stack[-1] += cumulative
+            sys.stderr.write(
+                'import time: {{:>9}} | {{:>10}} | {{}}{{}}\\n'.format(
+                    cumulative - children, cumulative, '  ' * len(stack),
+                    name))
+    return exec_timed
+
+
+sys.meta_path.insert(0, ImportTimer())
+sys.stderr = sys.stdout
+import split_settings.tools
+include = split_settings.tools.include
+split_settings.tools.include = timed_include
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', '{settings}')
+import zappa.handler
+import django
+django.setup()
+from django.core.wsgi import get_wsgi_application
+get_wsgi_application()
+'''
+
+# Static files are collected into STATIC_DIR by the manifest storage and
+# synced to S3 by sync_static(). The content hashes of the files in the
+# bucket are kept in STATIC_MANIFEST next to them.
+STATIC_DIR = '.zappa_static'
+STATIC_MANIFEST = '.zappa-static.json'
+STATIC_MARKER = 'ZAPPA_STATIC_TARGET '
+STATIC_SYNC_WORKERS = 16
+COLLECTSTATIC_SCRIPT = '''
+import json
+import django
+django.setup()
+from django.conf import settings
+from django.core.management import call_command
+settings.STATIC_ROOT = {static_root!r}
+settings.STATICFILES_STORAGE = (
+    'django.contrib.staticfiles.storage.ManifestStaticFilesStorage')
+call_command('collectstatic', interactive=False, clear=True, verbosity=0)
+print({marker!r} + json.dumps({{
+    'bucket': getattr(settings, 'AWS_S3_BUCKET_NAME_STATIC', '') or
+    getattr(settings, 'AWS_S3_BUCKET_NAME', ''),
+    'prefix': getattr(settings, 'AWS_S3_KEY_PREFIX_STATIC', ''),
+}}))
+'''
+
+# Lambda and RDS capacity of each Zappa stage, see stage_profile(). The
+# keep-warm interval is in minutes, 0 turns keep-warm off. Allocated
+# storage is in GB and provisioned IOPS need the io1 storage type.
+STAGE_PROFILES = {
+    'dev': {
+        'memory_size': 512,
+        'keep_warm_interval': 4,
+        'reserved_concurrency': None,
+        'db_instance_class': 'db.t2.micro',
+        'db_storage_type': 'gp2',
+        'db_allocated_storage': 20,
+        'db_iops': None,
+        'db_engine_version': '10.10',
+        'db_multi_az': False,
+        'db_read_replicas': 0,
+        'cache_node_type': 'cache.t2.micro',
+    },
+    'staging': {
+        'memory_size': 1024,
+        'keep_warm_interval': 4,
+        'reserved_concurrency': None,
+        'db_instance_class': 'db.t3.small',
+        'db_storage_type': 'gp2',
+        'db_allocated_storage': 20,
+        'db_iops': None,
+        'db_engine_version': '10.10',
+        'db_multi_az': False,
+        'db_read_replicas': 0,
+        'cache_node_type': 'cache.t3.small',
+    },
+    'prod': {
+        'memory_size': 1536,
+        'keep_warm_interval': 3,
+        'reserved_concurrency': 100,
+        'db_instance_class': 'db.m5.large',
+        'db_storage_type': 'gp2',
+        'db_allocated_storage': 100,
+        'db_iops': None,
+        'db_engine_version': '10.10',
+        'db_multi_az': True,
+        'db_read_replicas': 0,
+        'cache_node_type': 'cache.m5.large',
+    },
+}
+
+# Memory of the RDS instance classes in GiB, used to size the Postgres
+# parameters in db_parameters().
+DB_INSTANCE_MEMORY = {
+    'db.t2.micro': 1,
+    'db.t2.small': 2,
+    'db.t2.medium': 4,
+    'db.t2.large': 8,
+    'db.t3.micro': 1,
+    'db.t3.small': 2,
+    'db.t3.medium': 4,
+    'db.t3.large': 8,
+    'db.m5.large': 8,
+    'db.m5.xlarge': 16,
+    'db.m5.2xlarge': 32,
+    'db.m5.4xlarge': 64,
+    'db.r5.large': 16,
+    'db.r5.xlarge': 32,
+    'db.r5.2xlarge': 64,
+    'db.r5.4xlarge': 128,
+}
+
+# AWS Lambda prices in us-east-1, in dollars.
+LAMBDA_GB_SECOND_PRICE = 0.0000166667
+LAMBDA_REQUEST_PRICE = 0.0000002
+
+# Files left out of the Lambda package. Zappa matches these against file
+# and directory names. Distribution metadata and Django's locale data are
+# still read at run time, so they are only reported. So is bytecode: the
+# package is read-only on Lambda, and without it every cold start would
+# compile the dependencies again.
+PACKAGE_EXCLUDES = ['tests', '*.po', '.zappa_static']
+
+# Zappa's own excludes, used when a stage has no exclude setting. The
+# Lambda runtime provides these packages.
+ZAPPA_EXCLUDES = ['boto3', 'dateutil', 'botocore', 's3transfer', 'concurrent']
+
+# Uncompressed size above which Zappa's slim_handler is used, leaving
+# room below Lambda's 250 MB limit.
+SLIM_HANDLER_SIZE = 200 * 1024 * 1024
+MEGABYTE = 1024 * 1024
+
+# Generated settings components and modules, see
+# write_settings_components(). Each is a zappa_<name>.py file that is
+# copied into the Django project.
+SETTINGS_TEMPLATES = Path(__file__).resolve().parent / 'settings_templates'
+
+# Compose files adding the local Docker services that settings components
+# use. docker-compose reads the list from COMPOSE_FILE in .env, see
+# compose_files().
+COMPOSE_SERVICES = {
+    'cache': 'docker/compose-cache.yml',
+    'pooling': 'docker/compose-pooling.yml',
+    'replicas': 'docker/compose-replicas.yml',
+}
+
+# Set when a pipeline step fails so that steps waiting on AWS stop early.
+ABORT = threading.Event()
+
+# Timings of the finished setup phases, see phase().
+TRACE = []
+TRACE_LOCK = threading.Lock()
+CURRENT_PHASE = threading.local()
+
+# Address range of the VPC, split into a subnet per availability zone.
+VPC_CIDR = '172.31.0.0/16'
+
+# Held while zappa_settings.json is edited, see edit_zappa_settings().
+ZAPPA_SETTINGS_LOCK = threading.Lock()
+
+# Stage settings written by the package and deploy steps, which
+# create_zappa_settings() keeps when it rewrites a stage.
+ZAPPA_KEPT_SETTINGS = ('aws_environment_variables', 'exclude', 'slim_handler')
+
+# Stage setting recording the memory size "tune --write" chose, which
+# create_zappa_settings() keeps unless a memory size is given.
+ZAPPA_TUNED_MEMORY = 'tuned_memory_size'
+
 
 def validate_project_name(ctx, param, value):
     """Validate project name - only letters, numbers, and underscores."""
@@ -48,7 +386,29 @@ def accept_charges(ctx, param, value):
         exit(1)
 
 
-@click.command()
+class DefaultGroup(click.Group):
+    """Command group that falls back to a default command.
+
+    Keeps ``setup.py project_name --buildall`` working alongside the
+    named commands.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.default_command = kwargs.pop('default_command')
+        super().__init__(*args, **kwargs)
+
+    def parse_args(self, ctx, args):
+        if args and args[0] not in self.commands and args[0] != '--help':
+            args.insert(0, self.default_command)
+        return super().parse_args(ctx, args)
+
+
+@click.group(cls=DefaultGroup, default_command='deploy')
+def cli():
+    """Django - Docker - Zappa - AWS - Lambda."""
+
+
+@cli.command('deploy')
 @click.argument('project_name', callback=validate_project_name)
 @click.option('-B', '--buildall', is_flag=True, show_default=True,
               help='Build all')
@@ -75,9 +435,90 @@ def accept_charges(ctx, param, value):
               help="Django admin email")
 @click.option('--password', prompt='Enter your Django admin password',
               hide_input=True, confirmation_prompt=True,
+              envvar='ZAPPA_DJANGO_PASSWORD',
               help="Django admin password")
+@click.option('--worker/--no-worker', default=True, show_default=True,
+              help='Run container commands in one long-lived worker '
+                   'container instead of a new container per command.')
+@click.option('--verbose', is_flag=True, show_default=True,
+              help='Stream the output of container commands.')
+@click.option('--fresh', is_flag=True, show_default=True,
+              help='Ignore the steps finished by an earlier run.')
+@click.option('--stage', type=click.Choice(sorted(STAGE_PROFILES)),
+              default='dev', show_default=True,
+              help='Zappa stage to deploy, with its capacity profile.')
+@click.option('--memory-size', type=int,
+              help='Lambda memory size in MB, overriding the stage profile.')
+@click.option('--keep-warm-interval', type=int,
+              help='Minutes between keep-warm pings, 0 to disable, '
+                   'overriding the stage profile.')
+@click.option('--reserved-concurrency', type=int,
+              help='Reserved concurrent executions of the Lambda function, '
+                   'overriding the stage profile.')
+@click.option('--db-instance-class', type=click.Choice(
+    sorted(DB_INSTANCE_MEMORY)),
+              help='RDS instance class, overriding the stage profile.')
+@click.option('--db-storage-type', type=click.Choice(['gp2', 'io1',
+                                                      'standard']),
+              help='RDS storage type, overriding the stage profile.')
+@click.option('--db-allocated-storage', type=int,
+              help='RDS storage in GB, overriding the stage profile.')
+@click.option('--db-iops', type=int,
+              help='Provisioned IOPS of io1 storage, overriding the stage '
+                   'profile.')
+@click.option('--db-engine-version',
+              help='PostgreSQL version, overriding the stage profile.')
+@click.option('--db-multi-az/--no-db-multi-az', default=None,
+              help='Run a standby RDS instance in a second availability '
+                   'zone, overriding the stage profile.')
+@click.option('--db-read-replicas', type=int,
+              help='Number of RDS read replicas, overriding the stage '
+                   'profile.')
+@click.option('--cache/--no-cache', default=False, show_default=True,
+              help='Add an ElastiCache Redis cluster for the Django cache '
+                   'and sessions.')
+@click.option('--cache-node-type',
+              help='ElastiCache node type, overriding the stage profile.')
+@click.option('--region', 'regions', multiple=True,
+              help='AWS region to deploy to, can be repeated to deploy to '
+                   'several regions at once. Defaults to the region of '
+                   'the AWS profile.')
+@click.option('--shared-role-stack',
+              help='Use the role, VPC and security group of an existing '
+                   'stack instead of creating them.')
+@click.option('--shared-db-stack',
+              help='Use a database on the RDS instance of an existing stack '
+                   'instead of an instance of its own.')
+@click.option('--shared-db-password', envvar='ZAPPA_DJANGO_DB_PASSWORD',
+              help='Master password of the shared RDS instance.')
+@click.option('--api-rate', type=float,
+              help='Most AWS API calls per second.')
+@click.option('--vpc-endpoint', 'vpc_endpoints', multiple=True,
+              type=click.Choice(['lambda', 'secretsmanager', 'sqs']),
+              help='Add an interface VPC endpoint for an AWS service, '
+                   'can be repeated. S3 always has a gateway endpoint.')
+@click.option('--cdn/--no-cdn', default=False, show_default=True,
+              help='Serve the static files through a CloudFront '
+                   'distribution.')
+@click.option('--connection-pooling/--no-connection-pooling', default=False,
+              show_default=True,
+              help='Connect Django to Postgres through RDS Proxy on AWS '
+                   'and PgBouncer in Docker.')
+@click.option('--profile', is_flag=True, show_default=True,
+              help='Print the time spent in each setup phase.')
+@click.option('--trace', type=click.Path(dir_okay=False),
+              help='Write the setup phase timings to a JSON file.')
+@click.option('--chrome-trace', type=click.Path(dir_okay=False),
+              help='Write the setup phase timings in Chrome trace format.')
 def main(project_name, name, username, email, password, build, buildall,
-         requirements, startproject, virtual, acknowledge, zappa, template):
+         requirements, startproject, virtual, acknowledge, zappa, template,
+         worker, verbose, fresh, profile, trace, chrome_trace, stage,
+         memory_size, keep_warm_interval, reserved_concurrency,
+         db_instance_class, db_storage_type, db_allocated_storage, db_iops,
+         db_engine_version, db_multi_az, db_read_replicas,
+         cache, cache_node_type, regions, shared_role_stack, shared_db_stack,
+         shared_db_password, api_rate, vpc_endpoints, cdn,
+         connection_pooling):
     """Django - Docker - Zappa - AWS - Lambda.
 
     Build and deploy a Django app in Docker for local development and
@@ -85,66 +526,234 @@ def main(project_name, name, username, email, password, build, buildall,
     """
     start_time = time.monotonic()
 
-    session = create_boto_session()
+    capacity = stage_profile(
+        stage,
+        memory_size=memory_size,
+        keep_warm_interval=keep_warm_interval,
+        reserved_concurrency=reserved_concurrency,
+        db_instance_class=db_instance_class,
+        db_storage_type=db_storage_type,
+        db_allocated_storage=db_allocated_storage,
+        db_iops=db_iops,
+        db_engine_version=db_engine_version,
+        db_multi_az=db_multi_az,
+        db_read_replicas=db_read_replicas,
+        cache_node_type=cache_node_type
+    )
+    if connection_pooling and engine_version(
+            capacity['db_engine_version']) < (10, 10):
+        raise click.BadParameter(
+            'RDS Proxy needs PostgreSQL 10.10 or later.',
+            param_hint='--db-engine-version')
 
-    role_stack_name = create_role(project_name, session)
+    if shared_db_stack and not shared_db_password:
+        raise click.BadParameter(
+            'a shared RDS instance needs its master password.',
+            param_hint='--shared-db-password')
+    if (shared_role_stack or shared_db_stack) and len(regions) > 1:
+        raise click.BadParameter(
+            'shared stacks are in a single region.', param_hint='--region')
 
-    role_info = get_role_name(role_stack_name, session)
+    session = create_boto_session()
+    if api_rate:
+        rate_limit(session, api_rate)
 
-    env = create_env_file(project_name, name, email, session)
+    if fresh:
+        state = {'project_name': project_name, 'steps': {}}
+    else:
+        state = load_state(project_name)
 
-    stack_name = create_stack(
-        project_name, role_info, env['DB_PASSWORD'], session)
+    if state['steps']:
+        click.echo('Resuming the earlier run of {}.'.format(project_name))
+        env = create_env_file(
+            project_name, name, email, session, read_env_file())
+    else:
+        env = create_env_file(project_name, name, email, session)
+
+    # On a shared instance the project has a database of its own, which
+    # only the Lambda function uses, Docker keeps its local database.
+    db_environment = {}
+    if shared_db_stack:
+        update_env_file('DB_PASSWORD', shared_db_password)
+        env['DB_PASSWORD'] = shared_db_password
+        db_environment['DB_NAME'] = re.sub(
+            r'[^a-z0-9_]', '_', project_name.lower())
+
+    # Keep the compose project and host ports a batch gives the project
+    # for later docker-compose commands.
+    for variable in COMPOSE_VARIABLES:
+        if variable in os.environ:
+            update_env_file(variable, os.environ[variable])
 
     client = docker.from_env()
 
+    if worker:
+        runner = worker_runner
+    else:
+        runner = container_runner
+
+    cleanup = ExitStack()
+
+    def region_steps(session, stage, suffix='', env_file='.env',
+                     name_suffix=''):
+        """Build the AWS steps of a region, each name ending in suffix."""
+        def key(step_name):
+            return step_name + suffix
+
+        stack_steps = [
+            (key('role_stack'), (),
+             lambda results: shared_role_stack or create_role(
+                 project_name, session, vpc_endpoints, name_suffix)),
+            (key('role_info'), (key('role_stack'),),
+             lambda results: get_role_name(
+                 results[key('role_stack')], session)),
+            (key('stack'), (key('role_info'),),
+             lambda results: create_stack(
+                 project_name, results[key('role_info')],
+                 env['DB_PASSWORD'], session, connection_pooling, capacity,
+                 cdn, cache, name_suffix, database=not shared_db_stack
+             )),
+            (key('s3_bucket'), (), lambda results: create_s3_bucket_name()),
+            (key('zappa_settings'), (key('role_info'), key('s3_bucket')),
+             lambda results: create_zappa_settings(
+                 project_name, results[key('role_info')], session,
+                 results[key('s3_bucket')], stage, capacity,
+                 keep_tuned=memory_size is None
+             )),
+        ]
+        zappa_steps = [
+            (key('rds_host'), (key('stack'),),
+             lambda results: get_aws_rds_host(
+                 results[key('stack')], session, env_file, shared_db_stack)),
+            (key('lambda_host'), (key('rds_host'), 'package'),
+             lambda results: deploy_zappa_project(
+                 project_name, results['run'], session, stage, capacity,
+                 env_file, db_environment)),
+            (key('zappa'), (key('lambda_host'),),
+             lambda results: create_zappa_project(
+                 project_name, session, results['run'], username, email,
+                 password, stage, env_file, bool(shared_db_stack))),
+        ]
+        return stack_steps, zappa_steps
+
+    # A single region uses the plain step names, stage and .env file. With
+    # several regions each gets a stage, a journal entry for every step
+    # and a .env.<region> file of its own, and they are set up at once.
+    if len(regions) > 1:
+        deployments = []
+        for region in regions:
+            region_session = boto3.Session(
+                profile_name=session.profile_name, region_name=region)
+            if api_rate:
+                rate_limit(region_session, api_rate)
+            env_file = '.env.{}'.format(region)
+            update_env_file('AWS_STORAGE_BUCKET_NAME', 'zappa-{}-{}'.format(
+                stringcase.spinalcase(project_name), region), env_file)
+            deployments.append((
+                region_session, region_stage_name(stage, region),
+                '@' + region, env_file, '-' + region
+            ))
+    else:
+        if regions:
+            session = boto3.Session(
+                profile_name=session.profile_name, region_name=regions[0])
+            if api_rate:
+                rate_limit(session, api_rate)
+        deployments = [(session, stage, '', '.env', '')]
+
+    steps = []
+    zappa_steps = []
+    for deployment in deployments:
+        stack_steps, deploy_steps = region_steps(*deployment)
+        steps.extend(stack_steps)
+        zappa_steps.extend(deploy_steps)
+
+    # The local Docker work needs nothing from AWS, so it runs as a chain
+    # of its own alongside the CloudFormation stack waits.
+    local_steps = []
     if build or buildall:
-        click.echo('Building Docker image...', nl=False)
-        client.images.build(
-            path=str(Path.cwd()),
-            tag='{}_web:latest'.format(project_name)
-        )
-        click.secho(' done', fg='green')
-
+        local_steps.append(
+            ('build', lambda results: build_image(project_name, client)))
+    local_steps.append(
+        ('run', lambda results: cleanup.enter_context(
+            runner(project_name, client, verbose))))
     if virtual or buildall:
-        click.echo('Creating virtual Python environment...', nl=False)
-        client.containers.run(
-            '{}_web:latest'.format(project_name),
-            'python -m virtualenv ve',
-            remove=True,
-            volumes={
-                Path.cwd(): {'bind': '/var/task', 'mode': 'rw'},
-            }
-        )
-        click.secho(' done', fg='green')
-
+        local_steps.append(
+            ('virtual', lambda results: create_virtualenv(results['run'])))
     if requirements or buildall:
-        click.echo('Installing Python requirements...', nl=False)
-        client.containers.run(
-            '{}_web:latest'.format(project_name),
-            '/bin/bash -c \
-            "source ve/bin/activate && pip install -r requirements.txt"',
-            remove=True,
-            volumes={
-                Path.cwd(): {'bind': '/var/task', 'mode': 'rw'},
-            }
-        )
-        click.secho(' done', fg='green')
-
+        local_steps.append(
+            ('requirements', lambda results: install_requirements(
+                results['run'])))
     if startproject or buildall:
-        start_project(project_name, client, username,
-                      email, password, template)
-
-    create_zappa_settings(project_name, role_info, session)
+        local_steps.append(
+            ('startproject', lambda results: start_project(
+                project_name, results['run'], username, email, password,
+                template)))
+
+    components = {}
+    modules = {}
+    if connection_pooling:
+        components['pooling'] = settings_template('pooling')
+    if capacity['db_read_replicas']:
+        components['replicas'] = settings_template('replicas')
+        modules['db_router'] = settings_template('db_router')
+    if cdn:
+        components['cdn'] = settings_template('cdn')
+    if cache:
+        components['cache'] = settings_template('cache')
+    update_env_file('COMPOSE_FILE', compose_files(components))
+    if components:
+        local_steps.append(
+            ('settings', lambda results: write_settings_components(
+                project_name, components, modules)))
+
+    previous = ()
+    for step_name, function in local_steps:
+        steps.append((step_name, previous, function))
+        previous = (step_name,)
 
     if zappa or buildall:
-        aws_lambda_host = create_zappa_project(
-            project_name, stack_name, session,
-            client, username, email, password
-        )
-        click.echo('Django website is running at http://{}/dev/'.format(
-            aws_lambda_host
-        ))
+        settings_steps = tuple(
+            step_name for step_name, requires, function in steps
+            if step_name.startswith('zappa_settings'))
+        steps.append(('package', settings_steps + previous,
+                      lambda results: prune_package()))
+        steps.extend(zappa_steps)
+
+    checkpoints = ('role_stack', 'role_info', 'stack', 's3_bucket',
+                   'rds_host', 'lambda_host', 'zappa')
+    try:
+        with cleanup:
+            results = run_pipeline(
+                steps,
+                max_workers=4 * len(deployments),
+                state=state,
+                checkpoints=[
+                    step_name for step_name, requires, function in steps
+                    if step_name.split('@')[0] in checkpoints
+                ]
+            )
+    finally:
+        if trace:
+            write_trace(trace)
+        if chrome_trace:
+            write_chrome_trace(chrome_trace)
+        if profile:
+            echo_profile()
+
+    for region_session, stage_name, suffix, env_file, name_suffix in (
+            deployments):
+        if 'zappa' + suffix in results:
+            click.echo('Django website is running at http://{}/{}/'.format(
+                results['lambda_host' + suffix], stage_name
+            ))
+
+    timings = results['run'].timings
+    click.echo('Container commands: {} in {} ({})'.format(
+        len(timings),
+        format_duration(sum(seconds for command, seconds in timings)),
+        'worker container' if worker else 'container per command'
+    ))
 
     end_time = time.monotonic()
 
@@ -155,61 +764,1226 @@ def main(project_name, name, username, email, password, build, buildall,
     exit(0)
 
 
-def start_project(project_name, client, username, email, password, template):
-    """Start Django project."""
+@cli.command('importtime')
+@click.argument('project_name', callback=validate_project_name)
+@click.option('--threshold', default=10.0, show_default=True,
+              help='Flag packages whose import time grew by more than '
+                   'this many percent since the last run.')
+@click.option('--top', default=15, show_default=True,
+              help='Number of imports to show.')
+def importtime(project_name, threshold, top):
+    """Profile the cold-start imports of the Django project.
+
+    Imports the Zappa handler and sets up Django with the aws-dev
+    settings in the project's local web image, the way a Lambda cold
+    start does, and reports the slowest imports. Results are kept in
+    IMPORTTIME_FILE and compared with the previous run.
+    """
+    client = docker.from_env()
+    with container_runner(project_name, client) as run:
+        output = run(
+            ['ve/bin/python', '-c', IMPORTTIME_SCRIPT.format(
+                settings='{}.settings'.format(project_name))],
+            environment={'DJANGO_ENV': 'aws-dev'}
+        )
+    tree = parse_importtime(output.decode('utf-8', 'replace'))
+    profile = {
+        'time': time.time(),
+        'total': sum(node['cumulative'] for node in tree),
+        'packages': importtime_by_package(tree),
+    }
+
+    click.echo('{:>10} {:>10}  {}'.format('self ms', 'cumul. ms', 'import'))
+    for node, depth in rank_importtime(tree, top):
+        click.echo('{:>10.1f} {:>10.1f}  {}{}'.format(
+            node['self'] / 1000, node['cumulative'] / 1000, '  ' * depth,
+            node['name']))
+    click.echo('Total import time: {:.1f} ms'.format(profile['total'] / 1000))
+
+    try:
+        history = json.loads(Path(IMPORTTIME_FILE).read_text())
+    except (OSError, ValueError):
+        history = []
+    regressions = []
+    if history:
+        regressions = importtime_regressions(history[-1], profile, threshold)
+    for name, before, after in regressions:
+        click.secho('Regression: {} {:.1f} ms -> {:.1f} ms'.format(
+            name, before / 1000, after / 1000), fg='red')
+    history.append(profile)
+    Path(IMPORTTIME_FILE).write_text(json.dumps(history, indent=4))
+
+    exit(1 if regressions else 0)
+
+
+def parse_importtime(output):
+    """Parse ``-X importtime`` output into a tree of imports.
+
+    Lines are printed when an import finishes, so children come before
+    their parent and are indented one level deeper. Times are in
+    microseconds.
+    """
+    pending = {}
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_time, cumulative, name = line[len('import time:'):].split('|')
+        name = name[1:].rstrip()
+        depth = (len(name) - len(name.lstrip())) // 2
+        node = {
+            'name': name.strip(),
+            'self': int(self_time),
+            'cumulative': int(cumulative),
+            'children': pending.pop(depth + 1, []),
+        }
+        pending.setdefault(depth, []).append(node)
+
+    return pending.get(0, [])
+
+
+def walk_importtime(tree, depth=0):
+    """Yield every import of the tree with its depth."""
+    for node in tree:
+        yield node, depth
+        yield from walk_importtime(node['children'], depth + 1)
+
+
+def rank_importtime(tree, top):
+    """Get the ``top`` slowest imports of the tree with their depth.
+
+    Imports are picked by cumulative time, a child only once its parent
+    has been, so the result is still a tree. Children are listed under
+    their parent, slowest first.
+    """
+    picked = set()
+    candidates = [(-node['cumulative'], id(node), node) for node in tree]
+    heapq.heapify(candidates)
+    while candidates and len(picked) < top:
+        cumulative, key, node = heapq.heappop(candidates)
+        picked.add(key)
+        for child in node['children']:
+            heapq.heappush(
+                candidates, (-child['cumulative'], id(child), child))
+
+    def walk(nodes, depth):
+        for node in sorted(nodes, key=lambda node: node['cumulative'],
+                           reverse=True):
+            if id(node) in picked:
+                yield node, depth
+                yield from walk(node['children'], depth + 1)
+
+    return list(walk(tree, 0))
+
+
+def importtime_by_package(tree):
+    """Sum the import time of the tree by top-level package."""
+    packages = {}
+    for node, depth in walk_importtime(tree):
+        package = node['name'].split('.')[0]
+        packages[package] = packages.get(package, 0) + node['self']
+
+    return packages
+
+
+def importtime_regressions(before, after, threshold, minimum=1000):
+    """List the packages whose import time grew by over ``threshold``%.
+
+    Growth of less than ``minimum`` microseconds is ignored as noise.
+    Returns ``(name, before, after)`` tuples, the total included.
+    """
+    regressions = []
+    items = [('total', before['total'], after['total'])] + [
+        (name, before['packages'].get(name, 0), time_after)
+        for name, time_after in sorted(after['packages'].items())
+    ]
+    for name, time_before, time_after in items:
+        if (time_after - time_before > minimum and
+                time_after > time_before * (1 + threshold / 100)):
+            regressions.append((name, time_before, time_after))
+
+    return regressions
+
+
+@cli.command('tune')
+@click.argument('project_name', callback=validate_project_name)
+@click.option('--stage', type=click.Choice(sorted(STAGE_PROFILES)),
+              default='dev', show_default=True, help='Zappa stage to tune.')
+@click.option('--memory-sizes', default='256,512,1024,1536,2048',
+              show_default=True,
+              help='Comma separated memory sizes in MB to benchmark.')
+@click.option('--path', 'paths', multiple=True, default=['/'],
+              show_default=True, help='Request path to benchmark.')
+@click.option('--requests', default=20, show_default=True,
+              help='Requests per path and memory size.')
+@click.option('--tolerance', default=10.0, show_default=True,
+              help='Recommend the cheapest memory size whose p90 latency '
+                   'is within this many percent of the fastest.')
+@click.option('--write', is_flag=True, show_default=True,
+              help='Write the recommended memory size to '
+                   'zappa_settings.json.')
+@click.option('--local', is_flag=True, show_default=True,
+              help='Benchmark the lambci runtime container with Docker '
+                   'memory and CPU limits instead of AWS Lambda.')
+def tune(project_name, stage, memory_sizes, paths, requests, tolerance,
+         write, local):
+    """Benchmark the Lambda function at several memory sizes.
+
+    Sends the same requests to the Zappa handler at each memory size and
+    reports latency percentiles and the cost in GB-seconds, then
+    recommends a memory size.
+    """
+    try:
+        memory_sizes = [int(size) for size in memory_sizes.split(',')]
+        for memory_size in memory_sizes:
+            stage_profile(stage, memory_size=memory_size)
+    except ValueError:
+        raise click.BadParameter('memory sizes must be numbers.',
+                                 param_hint='--memory-sizes')
+
+    host = read_env_file().get('AWS_LAMBDA_HOST', 'localhost')
+    events = [api_gateway_event(path, host, stage) for path in paths]
+
+    if local:
+        client = docker.from_env()
+        with container_runner(project_name, client) as run:
+            run('/bin/bash -c "source ve/bin/activate \
+                && zappa save-python-settings-file {}"'.format(stage))
+
+        def benchmark(memory_size):
+            with local_lambda(client, memory_size) as lambda_client:
+                return benchmark_lambda(
+                    lambda_client, 'local', events, requests)
+        results = tune_memory(memory_sizes, benchmark)
+    else:
+        session = create_boto_session()
+        lambda_client = session.client('lambda')
+        function_name = get_lambda_function_name(project_name, stage)
+        original = lambda_client.get_function_configuration(
+            FunctionName=function_name)['MemorySize']
+
+        def benchmark(memory_size):
+            set_lambda_memory(lambda_client, function_name, memory_size)
+            return benchmark_lambda(
+                lambda_client, function_name, events, requests)
+        try:
+            results = tune_memory(memory_sizes, benchmark)
+        finally:
+            set_lambda_memory(lambda_client, function_name, original)
+
+    click.echo('{:>8} {:>9} {:>9} {:>9} {:>14}'.format(
+        'MB', 'p50 ms', 'p90 ms', 'p99 ms', '$ per 1M req'))
+    for result in results:
+        click.echo('{:>8} {:>9.0f} {:>9.0f} {:>9.0f} {:>14.2f}'.format(
+            result['memory_size'], result['p50'], result['p90'],
+            result['p99'], result['cost'] * 1000000))
+    recommended = recommend_memory(results, tolerance)
+    click.echo('Recommended memory size: {} MB'.format(recommended))
+
+    if write:
+        with edit_zappa_settings() as zappa:
+            zappa[stage]['memory_size'] = recommended
+            zappa[stage][ZAPPA_TUNED_MEMORY] = recommended
+        click.echo('Run "zappa update {}" to apply it.'.format(stage))
+
+
+def tune_memory(memory_sizes, benchmark):
+    """Summarize the benchmark of each memory size.
+
+    ``benchmark`` takes a memory size and returns a list of
+    ``(latency, billed_duration)`` samples in milliseconds.
+    """
+    results = []
+    for memory_size in memory_sizes:
+        click.echo('Benchmarking {} MB...'.format(memory_size), nl=False)
+        samples = benchmark(memory_size)
+        latencies = sorted(latency for latency, billed in samples)
+        gb_seconds = sum(
+            memory_size / 1024 * billed / 1000 for latency, billed in samples
+        ) / len(samples)
+        results.append({
+            'memory_size': memory_size,
+            'p50': percentile(latencies, 50),
+            'p90': percentile(latencies, 90),
+            'p99': percentile(latencies, 99),
+            'gb_seconds': gb_seconds,
+            'cost': gb_seconds * LAMBDA_GB_SECOND_PRICE +
+            LAMBDA_REQUEST_PRICE,
+        })
+        click.secho(' done', fg='green')
+
+    return results
+
+
+def percentile(values, percent):
+    """Get the nearest-rank percentile of sorted values."""
+    return values[max(0, math.ceil(len(values) * percent / 100) - 1)]
+
+
+def recommend_memory(results, tolerance):
+    """Pick the cheapest memory size with a p90 close to the fastest."""
+    fastest = min(result['p90'] for result in results)
+    candidates = [
+        result for result in results
+        if result['p90'] <= fastest * (1 + tolerance / 100)
+    ]
+
+    return min(candidates, key=lambda result: result['cost'])['memory_size']
+
+
+def benchmark_lambda(client, function_name, events, requests):
+    """Invoke the function with each event and time the invocations.
+
+    The first invocation warms the function up and is not counted.
+    Returns ``(latency, billed_duration)`` samples in milliseconds.
+    """
+    client.invoke(FunctionName=function_name, Payload=json.dumps(events[0]))
+    samples = []
+    for i in range(requests):
+        for event in events:
+            start = time.monotonic()
+            response = client.invoke(
+                FunctionName=function_name,
+                LogType='Tail',
+                Payload=json.dumps(event)
+            )
+            response['Payload'].read()
+            latency = (time.monotonic() - start) * 1000
+            log = base64.b64decode(response.get('LogResult', '')).decode(
+                'utf-8', 'replace')
+            billed = re.search(r'Billed Duration: (\d+)', log)
+            samples.append((latency, int(billed.group(1)) if billed
+                            else math.ceil(latency / 100) * 100))
+
+    return samples
+
+
+def set_lambda_memory(client, function_name, memory_size):
+    """Change the memory size of a function and wait for the update."""
+    client.update_function_configuration(
+        FunctionName=function_name, MemorySize=memory_size)
+    while client.get_function_configuration(
+            FunctionName=function_name).get(
+                'LastUpdateStatus', 'Successful') == 'InProgress':
+        sleep(1)
+
+
+@contextmanager
+def local_lambda(client, memory_size, timeout=60):
+    """Run the Zappa handler in the lambci runtime as a Lambda stand-in.
+
+    The container gets the memory of the benchmarked size and the CPU
+    share Lambda gives that size, one vCPU at 1769 MB. Yields a Lambda
+    client for the container's invoke API.
+    """
+    container = client.containers.run(
+        'lambci/lambda:python3.6',
+        'zappa.handler.lambda_handler',
+        detach=True,
+        environment={
+            'DOCKER_LAMBDA_STAY_OPEN': '1',
+            'AWS_LAMBDA_FUNCTION_MEMORY_SIZE': str(memory_size),
+            'AWS_LAMBDA_FUNCTION_TIMEOUT': str(timeout),
+            'PYTHONPATH': '/var/task/ve/lib/python3.6/site-packages',
+        },
+        mem_limit='{}m'.format(memory_size),
+        nano_cpus=int(memory_size / 1769 * 1000000000),
+        ports={'9001/tcp': None},
+        volumes={str(Path.cwd()): {'bind': '/var/task', 'mode': 'ro'}}
+    )
+    try:
+        container.reload()
+        port = int(container.ports['9001/tcp'][0]['HostPort'])
+        start = time.monotonic()
+        while True:
+            try:
+                socket.create_connection(('localhost', port), 1).close()
+                break
+            except OSError:
+                if time.monotonic() - start > timeout:
+                    raise
+                sleep(0.5)
+        yield boto3.client(
+            'lambda',
+            endpoint_url='http://localhost:{}'.format(port),
+            region_name='us-east-1',
+            aws_access_key_id='local',
+            aws_secret_access_key='local',
+            config=botocore.config.Config(read_timeout=timeout)
+        )
+    finally:
+        container.remove(force=True)
+
+
+def api_gateway_event(path, host, stage):
+    """Build the API Gateway proxy event of a GET request."""
+    return {
+        'resource': '/{proxy+}',
+        'path': path,
+        'httpMethod': 'GET',
+        'headers': {
+            'Host': host,
+            'X-Forwarded-Proto': 'https',
+            'X-Forwarded-Port': '443',
+        },
+        'queryStringParameters': None,
+        'pathParameters': {'proxy': path.lstrip('/')},
+        'stageVariables': None,
+        'requestContext': {
+            'stage': stage,
+            'httpMethod': 'GET',
+            'path': '/{}{}'.format(stage, path),
+            'identity': {'sourceIp': '127.0.0.1'},
+        },
+        'body': None,
+        'isBase64Encoded': False,
+    }
+
+
+@cli.command('batch')
+@click.argument('manifest', type=click.File())
+@click.option('--workers', default=4, show_default=True,
+              help='Number of projects set up at the same time.')
+@click.option('--api-rate', default=20.0, show_default=True,
+              help='Most AWS API calls per second, shared by all projects.')
+@click.option('--shared-db/--no-shared-db', default=False, show_default=True,
+              help='Give each project a database on one shared RDS '
+                   'instance.')
+@click.option('--stage', type=click.Choice(sorted(STAGE_PROFILES)),
+              default='dev', show_default=True,
+              help='Zappa stage to deploy, with its capacity profile.')
+@click.option('-y', '--acknowledge', is_flag=True, show_default=True,
+              prompt='AWS charges apply. Do you want to continue?',
+              help='Acknowledge AWS charges apply warning.',
+              callback=accept_charges)
+def batch(manifest, workers, api_rate, shared_db, stage, acknowledge):
+    """Set up the projects of a manifest at the same time.
+
+    The manifest is a JSON object with the ``name`` of the batch and a
+    list of ``projects``. Each has the ``directory`` holding its copy of
+    this setup, its ``project_name``, the ``name``, ``username``, ``email``
+    and ``password`` of its Django admin, and the deploy ``options``,
+    --buildall by default. The projects share one role, VPC and security
+    group, and with --shared-db one RDS instance. Their local Docker
+    services run side by side, each project on host ports of its own.
+    """
+    start_time = time.monotonic()
+
+    manifest = json.load(manifest)
+    batch_name = manifest.get('name', 'zappa_batch')
+    projects = manifest['projects']
+
+    session = create_boto_session()
+    rate_limit(session, api_rate)
+
+    try:
+        shared = json.loads(Path(BATCH_FILE).read_text())
+    except (OSError, ValueError):
+        shared = {}
+    if shared.get('name') != batch_name:
+        shared = {
+            'name': batch_name,
+            'db_password': ''.join(random.choices(
+                string.ascii_letters + string.digits, k=16)),
+        }
+    Path(BATCH_FILE).write_text(json.dumps(shared, indent=4, sort_keys=True))
+
+    click.echo('Creating the shared role, VPC and security group...')
+    role_stack = create_role(batch_name, session)
+    role_info = get_role_name(role_stack, session)
+    options = ['--shared-role-stack', role_stack]
+    if shared_db:
+        db_stack = create_stack(
+            batch_name, role_info, shared['db_password'], session,
+            capacity=stage_profile(stage))
+        options.extend(['--shared-db-stack', db_stack])
+
+    environment = dict(
+        os.environ,
+        AWS_PROFILE=session.profile_name,
+        ZAPPA_DJANGO_DB_PASSWORD=shared['db_password']
+    )
+
+    def launch(project):
+        command = [
+            sys.executable, 'setup.py', 'deploy', project['project_name'],
+            '--acknowledge', '--name', project['name'],
+            '--username', project['username'], '--email', project['email'],
+            '--stage', stage, '--api-rate', str(api_rate / workers)
+        ] + options + project.get('options', ['--buildall'])
+        with open(str(Path(project['directory'], BATCH_LOG)), 'w') as log:
+            return run_subprocess(
+                command,
+                cwd=project['directory'],
+                env=dict(environment,
+                         ZAPPA_DJANGO_PASSWORD=project['password'],
+                         **compose_environment(
+                             project['project_name'],
+                             projects.index(project))),
+                stdin=subprocess.DEVNULL,
+                stdout=log,
+                stderr=subprocess.STDOUT
+            ).returncode
+
+    click.echo('Setting up {} projects, {} at a time...'.format(
+        len(projects), workers))
+    results = run_batch(projects, workers, launch)
+
+    for result in results:
+        click.echo('  {:<32} {:<7} {}'.format(
+            result['project_name'],
+            'ok' if result['ok'] else 'failed',
+            format_duration(result['seconds'])
+        ))
+    click.echo('{} of {} projects set up, elapsed time: {}'.format(
+        sum(result['ok'] for result in results),
+        len(results),
+        format_duration(time.monotonic() - start_time)
+    ))
+
+    exit(0 if all(result['ok'] for result in results) else 1)
+
+
+def run_batch(projects, workers, launch):
+    """Run ``launch`` for each project, ``workers`` at a time.
+
+    ``launch`` returns the exit status of the project's setup. Returns a
+    result with the status and duration of each project, in manifest
+    order, and reports each project as it finishes.
+    """
+    def timed(project):
+        start = time.monotonic()
+        try:
+            returncode = launch(project)
+        except Exception as error:
+            click.echo('{}: {}'.format(project['project_name'], error))
+            returncode = None
+        result = {
+            'project_name': project['project_name'],
+            'ok': returncode == 0,
+            'returncode': returncode,
+            'seconds': time.monotonic() - start,
+        }
+        click.echo('{} {} after {}'.format(
+            result['project_name'],
+            'finished' if result['ok'] else 'failed',
+            format_duration(result['seconds'])
+        ))
+        return result
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(timed, projects))
+
+
+def compose_environment(project_name, number):
+    """Give the ``number``-th project of a batch its own compose project.
+
+    Returns the COMPOSE_VARIABLES, with host ports that do not collide
+    with those of the other projects.
+    """
+    environment = {'COMPOSE_PROJECT_NAME': project_name.lower()}
+    for offset, (variable, port) in enumerate(COMPOSE_PORTS):
+        environment[variable] = str(
+            BATCH_PORT_BASE + number * len(COMPOSE_PORTS) + offset)
+
+    return environment
+
+
+def rate_limit(session, calls_per_second):
+    """Space out the AWS API calls of the clients of a boto3 session.
+
+    Only clients created after this call are limited.
+    """
+    lock = threading.Lock()
+    next_call = [time.monotonic()]
+
+    def before_call(**kwargs):
+        with lock:
+            now = time.monotonic()
+            delay = next_call[0] - now
+            next_call[0] = max(next_call[0], now) + 1 / calls_per_second
+        if delay > 0:
+            sleep(delay)
+
+    session.events.register('before-parameter-build', before_call)
+
+
+@cli.command('destroy')
+@click.argument('project_name', callback=validate_project_name)
+@click.option('-y', '--yes', 'confirmed', is_flag=True, show_default=True,
+              help='Delete without asking for confirmation.')
+@click.option('--worker/--no-worker', default=True, show_default=True,
+              help='Run the Zappa commands in one long-lived container '
+                   'instead of one container per command.')
+@click.option('--verbose', is_flag=True, show_default=True,
+              help='Show the output of the Zappa commands.')
+@click.option('--if-exists', is_flag=True, show_default=True,
+              help='Do nothing when there is no setup of the project.')
+def destroy(project_name, confirmed, worker, verbose, if_exists):
+    """Delete what deploy set up on AWS for a project.
+
+    The Zappa stages of the project in zappa_settings.json are undeployed
+    and their deployment buckets deleted. The stacks are found in every
+    region the project was deployed to: the S3 buckets of the RDS stack
+    are emptied so that CloudFormation can delete them, then the RDS
+    stack is deleted and, once it and the Lambda functions in the VPC are
+    gone, the role, VPC and security group stack. Regions and stages are
+    torn down at the same time. Stacks shared with a batch are kept, see
+    destroy-batch.
+    """
+    start_time = time.monotonic()
+
+    state = load_state(project_name)
+    try:
+        zappa = json.loads(Path('zappa_settings.json').read_text())
+    except (OSError, ValueError):
+        zappa = {}
+    stages = {
+        stage: settings for stage, settings in zappa.items()
+        if settings.get('project_name') == project_name
+    }
+    if not stages and not state['steps']:
+        if if_exists:
+            click.echo('There is no setup of {} to destroy.'.format(
+                project_name))
+            exit(0)
+        click.echo('Error - There is no setup of {} to destroy.'.format(
+            project_name))
+        exit(1)
+
+    session = create_boto_session()
+    regions = {
+        stage_region(settings, session) for settings in stages.values()}
+    regions.update(
+        step_name.split('@')[1]
+        for step_name in state['steps'] if '@' in step_name)
+    regions = sorted(regions or [session.region_name])
+
+    rds_stack = '{}-Zappa-RDS-S3'.format(stringcase.pascalcase(project_name))
+    role_stack = '{}-Zappa-Role-VPC-SG'.format(
+        stringcase.pascalcase(project_name))
+    shared_role = any(
+        value != role_stack for step_name, value in state['steps'].items()
+        if step_name.split('@')[0] == 'role_stack'
+    )
+
+    click.echo('This deletes the Lambda functions, databases and S3 buckets '
+               'of {} in {}.'.format(project_name, ', '.join(regions)))
+    if not confirmed and not click.confirm('Do you want to continue?'):
+        exit(1)
+
+    sessions = {
+        region: boto3.Session(
+            profile_name=session.profile_name, region_name=region)
+        for region in regions
+    }
+
+    client = docker.from_env()
+
+    if worker:
+        runner = worker_runner
+    else:
+        runner = container_runner
+
+    cleanup = ExitStack()
+
+    def stage_steps(stage, settings):
+        """Undeploy a Zappa stage, then delete its deployment bucket."""
+        stage_session = sessions[stage_region(settings, session)]
+        return [
+            ('undeploy@' + stage, ('run',),
+             lambda results: undeploy_zappa(
+                 project_name, results['run'], stage_session, stage)),
+            ('zappa_bucket@' + stage, ('undeploy@' + stage,),
+             lambda results: delete_bucket(
+                 stage_session, settings['s3_bucket'])),
+        ]
+
+    def region_steps(region):
+        """Empty the buckets of a region, then delete its stacks."""
+        region_session = sessions[region]
+        steps = [
+            ('empty_buckets@' + region, (),
+             lambda results: [
+                 empty_bucket(region_session, bucket)
+                 for bucket in stack_buckets(rds_stack, region_session)
+             ]),
+            ('rds_stack@' + region, ('empty_buckets@' + region,),
+             lambda results: delete_stack(
+                 rds_stack, region_session, 'Delete RDS Stack')),
+        ]
+        if not shared_role:
+            undeploys = tuple(
+                'undeploy@' + stage
+                for stage, settings in sorted(stages.items())
+                if stage_region(settings, session) == region
+            )
+            steps.append((
+                'role_stack@' + region, ('rds_stack@' + region,) + undeploys,
+                lambda results: delete_stack(
+                    role_stack, region_session, 'Delete Role Stack')
+            ))
+        return steps
+
+    steps = []
+    if stages:
+        steps.append(('run', (), lambda results: cleanup.enter_context(
+            runner(project_name, client, verbose))))
+    for stage, settings in sorted(stages.items()):
+        steps.extend(stage_steps(stage, settings))
+    for region in regions:
+        steps.extend(region_steps(region))
+
+    with cleanup:
+        run_pipeline(steps, max_workers=4 * len(regions))
+
+    # The journal and the settings of the stages name resources that are
+    # gone, a later deploy starts from scratch.
+    try:
+        Path(STATE_FILE).unlink()
+    except FileNotFoundError:
+        pass
+    if stages:
+        with edit_zappa_settings() as settings:
+            for stage in stages:
+                settings.pop(stage, None)
+
+    click.echo('Destroyed {} in {}.'.format(
+        project_name, format_duration(time.monotonic() - start_time)))
+
+    exit(0)
+
+
+def stage_region(settings, session):
+    """Get the AWS region of a Zappa stage.
+
+    Stages set up before aws_region was written only have profile-region,
+    and without either Zappa uses the region of the AWS profile.
+    """
+    return (settings.get('aws_region') or settings.get('profile-region') or
+            session.region_name)
+
+
+@cli.command('destroy-batch')
+@click.argument('manifest', type=click.File())
+@click.option('--workers', default=4, show_default=True,
+              help='Number of projects destroyed at the same time.')
+@click.option('-y', '--yes', 'confirmed', is_flag=True, show_default=True,
+              help='Delete without asking for confirmation.')
+def destroy_batch(manifest, workers, confirmed):
+    """Delete the projects of a batch and the stacks they share.
+
+    Runs destroy in the directory of each project of the manifest, then
+    empties the S3 buckets of the shared RDS stack and deletes it and the
+    shared role, VPC and security group stack. The shared stacks are kept
+    when a project could not be destroyed, as its Lambda functions may
+    still be in the VPC.
+    """
+    start_time = time.monotonic()
+
+    manifest = json.load(manifest)
+    batch_name = manifest.get('name', 'zappa_batch')
+    projects = manifest['projects']
+
+    click.echo('This deletes the {} projects of {} and the stacks they '
+               'share.'.format(len(projects), batch_name))
+    if not confirmed and not click.confirm('Do you want to continue?'):
+        exit(1)
+
+    session = create_boto_session()
+    environment = dict(os.environ, AWS_PROFILE=session.profile_name)
+
+    def launch(project):
+        command = [
+            sys.executable, 'setup.py', 'destroy', project['project_name'],
+            '--yes', '--if-exists'
+        ]
+        with open(str(Path(project['directory'], BATCH_LOG)), 'a') as log:
+            return run_subprocess(
+                command,
+                cwd=project['directory'],
+                env=environment,
+                stdin=subprocess.DEVNULL,
+                stdout=log,
+                stderr=subprocess.STDOUT
+            ).returncode
+
+    click.echo('Destroying {} projects, {} at a time...'.format(
+        len(projects), workers))
+    results = run_batch(projects, workers, launch)
+
+    for result in results:
+        click.echo('  {:<32} {:<7} {}'.format(
+            result['project_name'],
+            'ok' if result['ok'] else 'failed',
+            format_duration(result['seconds'])
+        ))
+    if not all(result['ok'] for result in results):
+        click.echo('Error - The shared stacks of {} are kept until every '
+                   'project is destroyed.'.format(batch_name))
+        exit(1)
+
+    rds_stack = '{}-Zappa-RDS-S3'.format(stringcase.pascalcase(batch_name))
+    role_stack = '{}-Zappa-Role-VPC-SG'.format(
+        stringcase.pascalcase(batch_name))
+    for bucket in stack_buckets(rds_stack, session):
+        empty_bucket(session, bucket)
+    delete_stack(rds_stack, session, 'Delete RDS Stack')
+    delete_stack(role_stack, session, 'Delete Role Stack')
+    try:
+        Path(BATCH_FILE).unlink()
+    except FileNotFoundError:
+        pass
+
+    click.echo('Destroyed {} in {}.'.format(
+        batch_name, format_duration(time.monotonic() - start_time)))
+
+    exit(0)
+
+
+def run_pipeline(steps, max_workers=4, state=None, checkpoints=()):
+    """Run the setup steps, in parallel where they are independent.
+
+    ``steps`` is a list of ``(name, dependencies, function)`` tuples. A
+    step is started as soon as every step it depends on has finished and
+    its function is called with the dict of results collected so far.
+    The first failing step stops the pipeline: no new steps are started,
+    steps that are waiting on AWS are woken up and the error is re-raised.
+
+    The results of the steps named in ``checkpoints`` are recorded in the
+    ``state`` journal as they finish, and steps already recorded there by
+    an earlier run are not run again.
+    """
+    names = [step[0] for step in steps]
+    for step_name, dependencies, function in steps:
+        for dependency in dependencies:
+            if dependency not in names:
+                raise ValueError(
+                    'Step "{}" depends on unknown step "{}".'.format(
+                        step_name, dependency))
+
+    ABORT.clear()
+    results = {}
+    pending = list(steps)
+    running = {}
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        while pending or running:
+            ready = True
+            while ready:
+                ready = [s for s in pending if set(s[1]) <= set(results)]
+                for step in ready:
+                    pending.remove(step)
+                    step_name, dependencies, function = step
+                    if state is not None and step_name in state['steps']:
+                        results[step_name] = state['steps'][step_name]
+                        continue
+                    future = executor.submit(
+                        run_phase, step_name, function, dict(results))
+                    running[future] = step_name
+            if not pending and not running:
+                break
+            if not running:
+                raise ValueError(
+                    'Circular dependency between steps: {}'.format(
+                        ', '.join(step[0] for step in pending)))
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                step_name = running.pop(future)
+                results[step_name] = future.result()
+                if state is not None and step_name in checkpoints:
+                    state['steps'][step_name] = results[step_name]
+                    save_state(state)
+    except BaseException:
+        ABORT.set()
+        raise
+    finally:
+        executor.shutdown(wait=not ABORT.is_set())
+
+    return results
+
+
+def run_phase(step_name, function, results):
+    """Run a pipeline step as a phase of its own."""
+    with phase(step_name):
+        return function(results)
+
+
+def sleep(seconds):
+    """Sleep, bailing out early if another pipeline step has failed."""
+    start = time.monotonic()
+    aborted = ABORT.wait(seconds)
+    add_phase_time('wait', time.monotonic() - start)
+    if aborted:
+        exit(1)
+
+
+def run_subprocess(args, **kwargs):
+    """Run a local command, counting its time against the current phase."""
+    start = time.monotonic()
+    try:
+        return subprocess.run(args, **kwargs)
+    finally:
+        add_phase_time('subprocess', time.monotonic() - start)
+
+
+@contextmanager
+def phase(name):
+    """Record the start, end and wall time of a setup phase.
+
+    Time spent sleeping while waiting on AWS and time spent in local
+    commands or containers is added to the innermost phase of the thread
+    that spent it. Finished phases are appended to TRACE.
+    """
+    record = {
+        'name': name,
+        'thread': threading.current_thread().name,
+        'start': time.time(),
+        'wait': 0.0,
+        'subprocess': 0.0,
+    }
+    parent = getattr(CURRENT_PHASE, 'record', None)
+    CURRENT_PHASE.record = record
+    start = time.monotonic()
+    try:
+        yield record
+    finally:
+        record['wall'] = time.monotonic() - start
+        record['end'] = record['start'] + record['wall']
+        CURRENT_PHASE.record = parent
+        with TRACE_LOCK:
+            TRACE.append(record)
+
+
+def add_phase_time(kind, seconds):
+    """Add wait or subprocess time to the current thread's phase."""
+    record = getattr(CURRENT_PHASE, 'record', None)
+    if record is not None:
+        record[kind] += seconds
+
+
+def write_trace(path):
+    """Write the recorded phases as JSON."""
+    with open(path, 'w') as file:
+        file.write(json.dumps(TRACE, indent=4, sort_keys=True))
+
+
+def write_chrome_trace(path):
+    """Write the recorded phases in the Chrome trace event format."""
+    threads = []
+    events = []
+    for record in TRACE:
+        if record['thread'] not in threads:
+            threads.append(record['thread'])
+        events.append({
+            'name': record['name'],
+            'cat': 'setup',
+            'ph': 'X',
+            'ts': int(record['start'] * 1000000),
+            'dur': int(record['wall'] * 1000000),
+            'pid': 1,
+            'tid': threads.index(record['thread']),
+            'args': {
+                'wait': record['wait'],
+                'subprocess': record['subprocess'],
+            },
+        })
+    with open(path, 'w') as file:
+        file.write(json.dumps({'traceEvents': events}, indent=4))
+
+
+def echo_profile():
+    """Print a table of the recorded phases."""
+    click.echo('{:<16} {:>9} {:>9} {:>9}'.format(
+        'Phase', 'Wall', 'Wait', 'Process'))
+    for record in sorted(TRACE, key=lambda record: record['start']):
+        click.echo('{:<16} {:>9} {:>9} {:>9}'.format(
+            record['name'],
+            format_duration(record['wall']),
+            format_duration(record['wait']),
+            format_duration(record['subprocess'])
+        ))
+
+
+def build_image(project_name, client):
+    """Build the Docker image.
+
+    Only the Dockerfile and the files it copies are sent as the build
+    context. The image is labelled with a fingerprint of those files and
+    the base image, and the build is skipped when the tagged image already
+    carries the same fingerprint.
+    """
+    click.echo('Building Docker image...', nl=False)
+    tag = '{}_web:latest'.format(project_name)
+    paths = build_context_paths(Path('Dockerfile'))
+    fingerprint = image_fingerprint(client, paths)
+
+    try:
+        image = client.images.get(tag)
+        if image.labels.get(IMAGE_FINGERPRINT_LABEL) == fingerprint:
+            click.secho(' done (up to date)', fg='green')
+            return
+    except docker.errors.ImageNotFound:
+        pass
+
+    context = io.BytesIO()
+    with tarfile.open(fileobj=context, mode='w') as tar:
+        for path in paths:
+            tar.add(str(path), recursive=False)
+    context_size = context.tell()
+    context.seek(0)
+
+    start = time.monotonic()
+    client.images.build(
+        fileobj=context,
+        custom_context=True,
+        tag=tag,
+        labels={IMAGE_FINGERPRINT_LABEL: fingerprint}
+    )
+    click.secho(' done ({:.1f} kB context, {})'.format(
+        context_size / 1024, format_duration(time.monotonic() - start)
+    ), fg='green')
+
+
+def build_context_paths(dockerfile):
+    """Get the Dockerfile and every file its COPY and ADD lines use."""
+    paths = [dockerfile]
+    for line in dockerfile.read_text().splitlines():
+        tokens = line.split()
+        if not tokens or tokens[0].upper() not in ('ADD', 'COPY'):
+            continue
+        sources = [t for t in tokens[1:-1] if not t.startswith('--')]
+        for source in sources:
+            for path in sorted(Path('.').glob(source)):
+                paths.append(path)
+                if path.is_dir():
+                    paths.extend(sorted(path.rglob('*')))
+
+    return paths
+
+
+def image_fingerprint(client, paths):
+    """Hash the build context files and the Dockerfile's base image."""
+    digest = hashlib.sha256()
+    for line in paths[0].read_text().splitlines():
+        tokens = line.split()
+        if tokens and tokens[0].upper() == 'FROM':
+            try:
+                base_image = client.images.get(tokens[1])
+            except docker.errors.ImageNotFound:
+                base_image = client.images.pull(tokens[1])
+            digest.update(base_image.id.encode('utf-8'))
+    for path in paths:
+        digest.update(str(path).encode('utf-8'))
+        if path.is_file():
+            digest.update(path.read_bytes())
+
+    return digest.hexdigest()
+
+
+def create_virtualenv(run):
+    """Create the Python virtual environment."""
+    click.echo('Creating virtual Python environment...', nl=False)
+    run('python -m virtualenv ve')
+    click.secho(' done', fg='green')
+
+
+def install_requirements(run):
+    """Install requirements.txt into the virtual environment.
+
+    Wheels are built once into a wheelhouse on the pip cache volume, keyed
+    by the hash of requirements.txt and the container's Python runtime, and
+    installed from there without touching the network. When the virtual
+    environment was already installed with the same key the step is
+    skipped. Wheels are built into a directory of their own and renamed
+    into place, so runs that miss the same key at once, such as the
+    projects of a batch, do not write into each other's wheelhouse; the
+    run that loses the rename uses the winner's.
+    """
+    click.echo('Installing Python requirements...', nl=False)
+    key = requirements_key(run)
+    stamp_path = Path('ve') / '.requirements.json'
+    try:
+        stamp = json.loads(stamp_path.read_text())
+    except (OSError, ValueError):
+        stamp = {}
+    if stamp.get('key') == key:
+        click.secho(' done (cache hit, saved about {})'.format(
+            format_duration(stamp['seconds'])), fg='green')
+        return
+
+    wheelhouse = '{}/wheelhouse/{}'.format(PIP_CACHE_DIR, key)
+    start = time.monotonic()
+    try:
+        run('test -d {}'.format(wheelhouse))
+        cache = 'wheelhouse hit'
+    except docker.errors.ContainerError:
+        cache = 'cache miss'
+        run('/bin/bash -c "source ve/bin/activate \
+            && mkdir -p {1} \
+            && tmp=$(mktemp -d {0}.XXXXXX) \
+            && trap \'rm -rf $tmp\' EXIT \
+            && pip wheel -r requirements.txt -w $tmp \
+            && (mv -T $tmp {0} 2>/dev/null || test -d {0})"'.format(
+                wheelhouse, PIP_CACHE_DIR + '/wheelhouse'))
+    run('/bin/bash -c "source ve/bin/activate \
+        && pip install --no-index --find-links {} -r requirements.txt"'.format(
+            wheelhouse))
+    seconds = time.monotonic() - start
+
+    if cache == 'wheelhouse hit' and stamp.get('seconds', 0) > seconds:
+        cache = '{}, saved about {}'.format(
+            cache, format_duration(stamp['seconds'] - seconds))
+    stamp_path.write_text(json.dumps({
+        'key': key,
+        'seconds': max(seconds, stamp.get('seconds', 0)),
+    }))
+    click.secho(' done ({})'.format(cache), fg='green')
+
+
+def requirements_key(run):
+    """Hash requirements.txt together with the container's Python runtime."""
+    runtime = run(
+        'python -c "import platform, sys; '
+        'print(sys.version, platform.machine())"')
+    digest = hashlib.sha256(runtime)
+    digest.update(Path('requirements.txt').read_bytes())
+
+    return digest.hexdigest()[:16]
+
+
+def container_volumes():
+    """Volumes mounted into the project's web containers."""
+    return {
+        str(Path.cwd()): {'bind': '/var/task', 'mode': 'rw'},
+        '{}/.aws'.format(Path.home()): {
+            'bind': '/root/.aws',
+            'mode': 'ro'
+        },
+        PIP_CACHE_VOLUME: {'bind': PIP_CACHE_DIR, 'mode': 'rw'}
+    }
+
+
+@contextmanager
+def container_runner(project_name, client, verbose=False):
+    """Yield a runner that starts a new container for every command.
+
+    The runner takes a command and optional environment, returns the
+    command output and raises docker.errors.ContainerError when the
+    command exits with a non-zero status.
+    """
+    def run(command, environment=None):
+        start = time.monotonic()
+        try:
+            output = client.containers.run(
+                '{}_web:latest'.format(project_name),
+                command,
+                environment=environment,
+                remove=True,
+                volumes=container_volumes()
+            )
+        finally:
+            run.timings.append((command, time.monotonic() - start))
+            add_phase_time('subprocess', run.timings[-1][1])
+        if verbose:
+            click.echo(output.decode('utf-8', 'replace'), nl=False)
+        return output
+
+    run.timings = []
+    yield run
+
+
+@contextmanager
+def worker_runner(project_name, client, verbose=False):
+    """Yield a runner that executes commands in one long-lived container.
+
+    The worker container is started once and every command is sent into
+    it with exec, so container start-up is paid a single time. It takes
+    the same arguments and behaves like the container_runner runner. The
+    worker is removed when the context exits, even after an error.
+    """
+    image = '{}_web:latest'.format(project_name)
+    container = client.containers.run(
+        image,
+        'tail -f /dev/null',
+        detach=True,
+        volumes=container_volumes()
+    )
+
+    def run(command, environment=None):
+        start = time.monotonic()
+        try:
+            exec_id = client.api.exec_create(
+                container.id, command, environment=environment)
+            output = []
+            for chunk in client.api.exec_start(exec_id, stream=True):
+                if verbose:
+                    click.echo(chunk.decode('utf-8', 'replace'), nl=False)
+                output.append(chunk)
+            output = b''.join(output)
+            exit_code = client.api.exec_inspect(exec_id)['ExitCode']
+        finally:
+            run.timings.append((command, time.monotonic() - start))
+            add_phase_time('subprocess', run.timings[-1][1])
+        if exit_code != 0:
+            raise docker.errors.ContainerError(
+                container, exit_code, command, image, output)
+        return output
+
+    run.timings = []
+    try:
+        yield run
+    finally:
+        container.remove(force=True)
+
+
+def start_project(project_name, run, username, email, password, template):
+    """Start Django project.
+
+    The Postgres of the compose project is probed on the host port in
+    DB_HOST_PORT of .env, which a batch sets for each of its projects.
+    """
     if Path(project_name).exists():
         click.echo('Error: a project named "{}" already exists.'.format(
             project_name))
     else:
         click.echo('Run Django startproject...', nl=False)
-        client.containers.run(
-            '{}_web:latest'.format(project_name),
+        run(
             've/bin/django-admin startproject {} . --template={}'.format(
                 project_name,
                 template
-            ),
-            remove=True,
-            volumes={
-                Path.cwd(): {'bind': '/var/task', 'mode': 'rw'},
-            }
+            )
         )
         click.secho(' done', fg='green')
 
+        port = int(read_env_file().get(
+            'DB_HOST_PORT', dict(COMPOSE_PORTS)['DB_HOST_PORT']))
+
         click.echo('Build Docker container:')
         click.echo('---------------------------------------------------------')
-        subprocess.run(['docker-compose', 'build'])
+        docker_compose('build')
         click.echo('---------------------------------------------------------')
         click.secho('... done', fg='green')
         click.echo('Run initial Django migration in Docker container:')
         click.echo('---------------------------------------------------------')
-        subprocess.run(['docker-compose', 'down'])
+        docker_compose('down')
 
-        subprocess.run([
-            'docker-compose',
-            'run',
-            '--rm',
-            '-d',
-            'db',
-            'postgres'
-        ])
+        docker_compose('up', '-d', 'db')
 
-        subprocess.run([
-            'docker-compose',
+        wait_for_postgres(port=port)
+        docker_compose(
             'run',
             '--rm',
             'web',
             '/var/task/manage.py',
             'migrate'
-        ])
-        subprocess.run(['docker-compose', 'down'])
+        )
         click.echo('---------------------------------------------------------')
         click.secho('... done', fg='green')
 
         click.echo('Run Django createsuperuser in Docker container:')
-        click.echo('---------------------------------------------------------') 
-        time.sleep(30)
-        subprocess.run([
-            'docker-compose',
+        click.echo('---------------------------------------------------------')
+        wait_for_postgres(port=port)
+        docker_compose(
             'run',
             '--rm',
             'web',
@@ -221,94 +1995,472 @@ def start_project(project_name, client, username, email, password, template):
                 User.objects.create_superuser('{}', '{}', '{}')"'''.format(
                     username, email, password
             )
-        ])
-        subprocess.run(['docker-compose', 'down'])
+        )
+        docker_compose('down')
         click.echo('---------------------------------------------------------')
         click.secho('... done', fg='green')
 
 
-def create_zappa_project(
-    project_name, stack_name, session, client, username, email, password
-):
-    """Create the Zappa project."""
-    aws_rds_host = get_aws_rds_host(stack_name, session)
+def docker_compose(*args):
+    """Run a docker-compose command, exiting when it fails."""
+    result = run_subprocess(['docker-compose'] + list(args))
+    if result.returncode != 0:
+        click.echo('Error - "docker-compose {}" exited with status {}.'.format(
+            ' '.join(args[:4]), result.returncode))
+        exit(1)
 
-    with open('.env', 'a') as file:
-        file.write('AWS_RDS_HOST={}\n'.format(aws_rds_host))
+    return result
 
-    aws_lambda_host = deploy_zappa(project_name, client)
 
-    with open('.env', 'a') as file:
-        file.write('AWS_LAMBDA_HOST={}\n'.format(aws_lambda_host))
+def wait_for_postgres(host='localhost', port=5432, timeout=120, delay=0.5,
+                      max_delay=5):
+    """Wait until the docker-compose Postgres service accepts queries.
 
-    update_zappa(project_name, client)
+    Probes the published port with a TCP connect and then runs SELECT 1
+    through psql in the db container, backing off exponentially between
+    attempts. Returns the number of seconds waited.
+    """
+    start = time.monotonic()
+    while True:
+        try:
+            socket.create_connection((host, port), timeout=2).close()
+            result = run_subprocess(
+                ['docker-compose', 'exec', '-T', 'db', 'psql', '-h',
+                 '127.0.0.1', '-U', 'postgres', '-tAc', 'SELECT 1'],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL
+            )
+            if result.returncode == 0 and result.stdout.strip() == b'1':
+                return time.monotonic() - start
+        except OSError:
+            pass
+        if time.monotonic() - start + delay > timeout:
+            click.echo(
+                'Error - Postgres was not ready after {} seconds.'.format(
+                    timeout))
+            exit(1)
+        sleep(delay)
+        delay = min(delay * 2, max_delay)
 
-    click.echo(
-        'Run initial Django migration for Zappa deployment...', nl=False
-    )
-    client.containers.run(
-        '{}_web:latest'.format(project_name),
-        '/bin/bash -c "source ve/bin/activate && zappa manage dev migrate"',
-        remove=True,
-        volumes={
-            Path.cwd(): {'bind': '/var/task', 'mode': 'rw'},
-            '{}/.aws'.format(Path.home()): {
-                'bind': '/root/.aws',
-                'mode': 'ro'
-            }
-        }
-    )
+
+def write_settings_components(project_name, components, modules=None):
+    """Write generated settings files into the Django project.
+
+    Each component is written to settings/components/zappa_<name>.py and
+    included at the end of the project's split settings, so it can change
+    what the template's own settings files define. ``modules`` are
+    written to the project package, for settings that name a class.
+    """
+    settings = Path(project_name, 'settings')
+    if not (settings / '__init__.py').exists():
+        click.echo('Error - {} has no settings package.'.format(settings))
+        exit(1)
+
+    for name, code in sorted((modules or {}).items()):
+        Path(project_name, '{}.py'.format(name)).write_text(code)
+
+    init = (settings / '__init__.py').read_text()
+    includes = []
+    for name, code in sorted(components.items()):
+        path = 'components/zappa_{}.py'.format(name)
+        (settings / path).parent.mkdir(exist_ok=True)
+        (settings / path).write_text(code)
+        include = "include('{}')".format(path)
+        if include not in init:
+            includes.append(include)
+
+    if includes:
+        with (settings / '__init__.py').open('a') as file:
+            file.write('\n# Generated by setup.py\n')
+            file.write('from split_settings.tools import include  # noqa\n')
+            file.write(''.join(line + '\n' for line in includes))
+
+    return sorted(components)
+
+
+def compose_files(components):
+    """Get the COMPOSE_FILE that runs the services of the components.
+
+    Only the services of the optional features that are set up are
+    started with the local web container.
+    """
+    return os.pathsep.join(['docker-compose.yml'] + [
+        COMPOSE_SERVICES[name] for name in sorted(components)
+        if name in COMPOSE_SERVICES
+    ])
+
+
+def settings_template(name):
+    """Read the generated settings file of a feature."""
+    return (SETTINGS_TEMPLATES / 'zappa_{}.py'.format(name)).read_text()
+
+
+def prune_package(path='ve'):
+    """Report the Lambda package size and write its exclude settings.
+
+    Measures what each installed package in the virtual environment adds
+    to the package, and how much of it is tests, bytecode caches,
+    distribution metadata, translations and static files. The patterns
+    of PACKAGE_EXCLUDES are added to the exclude setting of each stage,
+    which starts from Zappa's defaults, and slim_handler is set when the
+    pruned package is still too big to load directly.
+    """
+    click.echo('Analyzing Lambda package size...')
+    report = analyze_package(path)
+    for name, size in sorted(report['packages'].items(),
+                             key=lambda item: item[1], reverse=True)[:10]:
+        click.echo('  {:<32} {:>8.1f} MB'.format(name, size / MEGABYTE))
+    for category, size in sorted(report['categories'].items()):
+        click.echo('  {:<32} {:>8.1f} MB'.format(
+            '({})'.format(category), size / MEGABYTE))
+    pruned = report['total'] - report['excluded']
+    click.echo('  {:.1f} MB in total, {:.1f} MB after pruning'.format(
+        report['total'] / MEGABYTE, pruned / MEGABYTE))
+
+    with edit_zappa_settings() as zappa:
+        for stage in zappa.values():
+            exclude = stage.get('exclude', ZAPPA_EXCLUDES)
+            stage['exclude'] = exclude + [
+                pattern for pattern in PACKAGE_EXCLUDES
+                if pattern not in exclude
+            ]
+            stage['slim_handler'] = pruned > SLIM_HANDLER_SIZE
+    click.secho('... done', fg='green')
+
+    return report
+
+
+def analyze_package(path='ve'):
+    """Measure the installed packages of a virtual environment.
+
+    Returns the total size, the size of each top-level package, the size
+    per category of files that are not needed to run the code, and how
+    much of the total ZAPPA_EXCLUDES and PACKAGE_EXCLUDES remove.
+    """
+    report = {
+        'total': 0,
+        'excluded': 0,
+        'packages': {},
+        'categories': {
+            'tests': 0, '__pycache__': 0, 'dist-info': 0, 'locale': 0,
+            'static': 0,
+        },
+    }
+    for site_packages in Path(path).glob('lib/python*/site-packages'):
+        for file in site_packages.rglob('*'):
+            if not file.is_file() or file.is_symlink():
+                continue
+            size = file.stat().st_size
+            parts = file.relative_to(site_packages).parts
+            package = re.sub(r'-[^-]*\.(dist|egg)-info$', '', parts[0])
+            report['total'] += size
+            report['packages'][package] = (
+                report['packages'].get(package, 0) + size)
+            if 'tests' in parts[:-1]:
+                report['categories']['tests'] += size
+            elif '__pycache__' in parts or file.suffix == '.pyc':
+                report['categories']['__pycache__'] += size
+            elif parts[0].endswith(('.dist-info', '.egg-info')):
+                report['categories']['dist-info'] += size
+            elif 'locale' in parts[:-1] or file.suffix in ('.po', '.mo'):
+                report['categories']['locale'] += size
+            elif 'static' in parts[:-1]:
+                report['categories']['static'] += size
+            if any(fnmatch.fnmatch(part, pattern) for part in parts
+                   for pattern in ZAPPA_EXCLUDES + PACKAGE_EXCLUDES):
+                report['excluded'] += size
+
+    return report
+
+
+def deploy_zappa_project(project_name, run, session, stage='dev',
+                         capacity=None, env_file='.env', environment=None):
+    """Deploy the Zappa project and add its Lambda host to .env.
+
+    The package, and the .env file in it, is shared by all regions of a
+    multi-region run, so the values of a region's own ``env_file`` are
+    set as environment variables of its stage, which take precedence.
+    So are the values of ``environment``.
+    """
+    variables = read_env_file(env_file) if env_file != '.env' else {}
+    variables.update(environment or {})
+    if variables:
+        with edit_zappa_settings() as zappa:
+            zappa[stage].setdefault('aws_environment_variables', {}).update(
+                variables)
+
+    deploy_zappa(run, stage)
+
+    aws_lambda_host = get_lambda_host(project_name, session, stage)
+
+    update_env_file('AWS_LAMBDA_HOST', aws_lambda_host, env_file)
+
+    update_zappa(project_name, aws_lambda_host, session, stage)
+
+    if capacity and capacity['reserved_concurrency']:
+        session.client('lambda').put_function_concurrency(
+            FunctionName=get_lambda_function_name(project_name, stage),
+            ReservedConcurrentExecutions=capacity['reserved_concurrency']
+        )
+
+    return aws_lambda_host
+
+
+def create_zappa_project(project_name, session, run, username, email,
+                         password, stage='dev', env_file='.env',
+                         create_database=False):
+    """Migrate, create the superuser and collect static files on AWS.
+
+    The migration and the superuser are done by a single Lambda
+    invocation, which first creates the project's database on a shared
+    RDS instance with ``create_database``. collectstatic runs locally and
+    the files it collects are synced to S3 by sync_static().
+    """
+    commands = [
+        ('manage', 'migrate --noinput'),
+        ('python', SUPERUSER_SNIPPET.format(
+            username=json.dumps(username),
+            email=json.dumps(email),
+            password=json.dumps(password)
+        )),
+    ]
+    if create_database:
+        commands.insert(0, ('python', CREATE_DATABASE_SNIPPET))
+
+    click.echo('Bootstrapping Django on AWS Lambda...')
+    with phase('bootstrap'):
+        results = run_bootstrap(
+            session,
+            get_lambda_function_name(project_name, stage),
+            commands
+        )
+    for result in results:
+        click.echo('  {:<24} {:>6.1f}s {}'.format(
+            result['command'][:24],
+            result['seconds'],
+            'ok' if result['ok'] else result['error']
+        ))
+    if not all(result['ok'] for result in results):
+        click.echo('Error - Bootstrapping Django on AWS Lambda failed.')
+        exit(1)
+    click.secho('... done', fg='green')
+
+    environment = {
+        'DJANGO_ENV': 'aws-dev',
+        'DJANGO_SETTINGS_MODULE': '{}.settings'.format(project_name)
+    }
+    if env_file != '.env':
+        environment.update(read_env_file(env_file))
+    static_dir = '{}/{}'.format(STATIC_DIR, stage)
+
+    click.echo('Running collectstatic for Zappa deployment...', nl=False)
+    with phase('collectstatic'):
+        output = run(
+            ['ve/bin/python', '-c', COLLECTSTATIC_SCRIPT.format(
+                static_root='/var/task/{}'.format(static_dir),
+                marker=STATIC_MARKER
+            )],
+            environment=environment
+        )
+    click.secho(' done', fg='green')
+
+    target = {'bucket': '', 'prefix': ''}
+    for line in output.decode('utf-8', 'replace').splitlines():
+        if line.startswith(STATIC_MARKER):
+            target = json.loads(line[len(STATIC_MARKER):])
+
+    click.echo('Syncing static files to S3...', nl=False)
+    with phase('sync'):
+        report = sync_static(
+            session,
+            target['bucket'] or read_env_file(env_file)[
+                'AWS_STORAGE_BUCKET_NAME'],
+            static_dir,
+            target['prefix']
+        )
     click.secho(' done', fg='green')
     click.echo(
-        'Create Django superuser {} for Zappa...'.format(username), nl=False
-    )
+        '  uploaded {} files ({:.1f} MB), skipped {} unchanged '
+        '({:.1f} MB)'.format(
+            report['uploaded'], report['uploaded_bytes'] / MEGABYTE,
+            report['skipped'], report['skipped_bytes'] / MEGABYTE
+        ))
+
+
+def sync_static(session, bucket, path=STATIC_DIR, prefix='',
+                workers=STATIC_SYNC_WORKERS):
+    """Upload the new and changed static files to S3.
+
+    The SHA-256 of every file under ``path`` is compared with the manifest
+    stored in the bucket by the previous sync, and only files whose hash
+    differs are uploaded, ``workers`` at a time. Names hashed by the
+    manifest storage never change content, so they get a Cache-Control of
+    a year; other files are cached for five minutes. Returns the number
+    of files and bytes uploaded and skipped.
+    """
+    client = session.client('s3')
+    prefix = prefix.strip('/') + '/' if prefix.strip('/') else ''
+    root = Path(path)
+
     try:
-        django_command = '''from django.contrib.auth import get_user_model; \
-        User = get_user_model(); \
-        User.objects.create_superuser(\\"{}\\", \\"{}\\", \\"{}\\")'''.format(
-                username, email, password
-        )
-        bash_command = 'source ve/bin/activate \
-        && zappa invoke --raw dev "{}"'.format(django_command)
-        zappa_command = "/bin/bash -c '{}'".format(bash_command)
-        client.containers.run(
-            '{}_web:latest'.format(project_name),
-            zappa_command,
-            remove=True,
-            volumes={
-                Path.cwd(): {'bind': '/var/task', 'mode': 'rw'},
-                '{}/.aws'.format(Path.home()): {
-                    'bind': '/root/.aws',
-                    'mode': 'ro'
-                }
-            }
+        response = client.get_object(
+            Bucket=bucket, Key=prefix + STATIC_MANIFEST)
+        remote = json.loads(response['Body'].read().decode('utf-8'))
+    except botocore.exceptions.ClientError as error:
+        if error.response['Error']['Code'] not in ('NoSuchKey', '404'):
+            raise
+        remote = {}
+
+    hashed_names = set()
+    if (root / 'staticfiles.json').exists():
+        manifest = json.loads((root / 'staticfiles.json').read_text())
+        hashed_names.update(manifest.get('paths', {}).values())
+
+    local = {}
+    sizes = {}
+    for file in sorted(root.rglob('*')):
+        if file.is_file():
+            name = file.relative_to(root).as_posix()
+            local[name] = hashlib.sha256(file.read_bytes()).hexdigest()
+            sizes[name] = file.stat().st_size
+    changed = [name for name in local if remote.get(name) != local[name]]
+
+    def upload(name):
+        content_type = mimetypes.guess_type(name)[0]
+        client.put_object(
+            Bucket=bucket,
+            Key=prefix + name,
+            Body=(root / name).read_bytes(),
+            ACL='public-read',
+            ContentType=content_type or 'application/octet-stream',
+            CacheControl=(
+                'public, max-age=31536000, immutable'
+                if name in hashed_names else 'public, max-age=300')
         )
-        click.secho(' done', fg='green')
-    except docker.errors.ContainerError:
-        pass
 
-    click.echo('Running collectstatic for Zappa deployment...', nl=False)
-    client.containers.run(
-        '{}_web:latest'.format(project_name),
-        '/bin/bash -c "source ve/bin/activate \
-        && python manage.py collectstatic --noinput"',
-        environment={'DJANGO_ENV': 'aws-dev'},
-        remove=True,
-        volumes={
-            Path.cwd(): {'bind': '/var/task', 'mode': 'rw'},
-            '{}/.aws'.format(Path.home()): {
-                'bind': '/root/.aws',
-                'mode': 'ro'
-            }
-        }
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for future in [executor.submit(upload, name) for name in changed]:
+            future.result()
+
+    remote.update(local)
+    client.put_object(
+        Bucket=bucket,
+        Key=prefix + STATIC_MANIFEST,
+        Body=json.dumps(remote, indent=4, sort_keys=True).encode('utf-8'),
+        ContentType='application/json'
     )
-    click.secho(' done', fg='green')
 
-    return(aws_lambda_host)
+    return {
+        'uploaded': len(changed),
+        'uploaded_bytes': sum(sizes[name] for name in changed),
+        'skipped': len(local) - len(changed),
+        'skipped_bytes': sum(sizes.values()) - sum(
+            sizes[name] for name in changed),
+    }
+
+
+def empty_bucket(session, bucket, workers=STATIC_SYNC_WORKERS):
+    """Delete every object of an S3 bucket.
+
+    Keys are listed S3_DELETE_BATCH at a time and each page is deleted
+    with a single DeleteObjects request, ``workers`` requests at a time.
+    A bucket that does not exist is empty. Returns the number of objects
+    deleted.
+    """
+    client = session.client('s3')
+    deleted = [0]
+    lock = threading.Lock()
+
+    def delete(keys):
+        response = client.delete_objects(
+            Bucket=bucket,
+            Delete={'Objects': [{'Key': key} for key in keys], 'Quiet': True}
+        )
+        errors = response.get('Errors', [])
+        if errors:
+            click.echo('Error - Could not delete {} objects of {}: {}'.format(
+                len(errors), bucket, errors[0]['Message']))
+            exit(1)
+        with lock:
+            deleted[0] += len(keys)
+            click.echo('  {} objects deleted from {}'.format(
+                deleted[0], bucket))
+
+    click.echo('Emptying bucket {}...'.format(bucket))
+    paginator = client.get_paginator('list_objects_v2')
+    futures = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            for page in paginator.paginate(
+                    Bucket=bucket,
+                    PaginationConfig={'PageSize': S3_DELETE_BATCH}):
+                keys = [item['Key'] for item in page.get('Contents', [])]
+                if keys:
+                    futures.append(executor.submit(delete, keys))
+        except client.exceptions.NoSuchBucket:
+            click.echo('Bucket {} does not exist.'.format(bucket))
+        for future in futures:
+            future.result()
+
+    return deleted[0]
+
+
+def delete_bucket(session, bucket):
+    """Empty and delete an S3 bucket, unless it is already gone."""
+    empty_bucket(session, bucket)
+    client = session.client('s3')
+    try:
+        client.delete_bucket(Bucket=bucket)
+    except client.exceptions.NoSuchBucket:
+        return
+    click.secho('Bucket {} deleted.'.format(bucket), fg='green')
+
+
+def run_bootstrap(session, function_name, commands, endpoint_url=None,
+                  timeout=300):
+    """Run management commands and Python snippets in one Lambda invocation.
+
+    ``commands`` is an ordered list of ``('manage', command)`` and
+    ``('python', code)`` tuples. They are sent together to the Zappa
+    handler as a raw command and run in order until one fails. Returns a
+    list of dicts with each command's result, output and timing, read from
+    the invocation's log tail. ``endpoint_url`` points the Lambda client
+    at a local stand-in such as the lambci/lambda runtime image.
+    """
+    client = session.client(
+        'lambda',
+        endpoint_url=endpoint_url,
+        config=botocore.config.Config(read_timeout=timeout + 10)
+    )
+    response = client.invoke(
+        FunctionName=function_name,
+        InvocationType='RequestResponse',
+        LogType='Tail',
+        Payload=json.dumps({'raw_command': BOOTSTRAP_SCRIPT.format(
+            commands=json.dumps(json.dumps(commands)),
+            marker=BOOTSTRAP_MARKER
+        )})
+    )
+    log = base64.b64decode(response.get('LogResult', '')).decode(
+        'utf-8', 'replace')
+    for line in log.splitlines():
+        if BOOTSTRAP_MARKER in line:
+            return json.loads(line.split(BOOTSTRAP_MARKER, 1)[1])
+
+    click.echo('Error - No bootstrap results from {}: {}'.format(
+        function_name,
+        response.get('FunctionError') or log[-500:]
+    ))
+    exit(1)
+
 
+def create_env_file(project_name, name, email, session, previous=None):
+    """Create the .env file.
 
-def create_env_file(project_name, name, email, session):
-    """Create the .env file."""
+    When resuming an earlier run, ``previous`` holds the values of its
+    .env file: the generated secrets and any values added since are kept,
+    so the database password still matches the RDS instance.
+    """
     env = {
         'PROJECT_NAME': project_name,
         'ADMIN_USER': name,
@@ -326,11 +2478,57 @@ def create_env_file(project_name, name, email, session):
             stringcase.spinalcase(project_name)
         )
     }
+    for key, value in (previous or {}).items():
+        if key not in env or key in ('DB_PASSWORD', 'DJANGO_SECRET_KEY'):
+            env[key] = value
     with open('.env', 'w') as file:
         for e in env:
             file.write('{}={}\n'.format(e, env[e]))
 
-    return env
+    return env
+
+
+def read_env_file(path='.env'):
+    """Read the values of a .env file."""
+    env = {}
+    try:
+        with open(path) as file:
+            for line in file:
+                if '=' in line:
+                    key, value = line.rstrip('\n').split('=', 1)
+                    env[key] = value
+    except FileNotFoundError:
+        pass
+
+    return env
+
+
+def update_env_file(key, value, path='.env'):
+    """Set a value in the .env file, replacing any earlier value."""
+    env = read_env_file(path)
+    env[key] = value
+    with open(path, 'w') as file:
+        for e in env:
+            file.write('{}={}\n'.format(e, env[e]))
+
+
+def load_state(project_name):
+    """Load the step journal of an earlier run for the same project."""
+    try:
+        state = json.loads(Path(STATE_FILE).read_text())
+    except (OSError, ValueError):
+        state = {}
+    if state.get('project_name') != project_name:
+        state = {'project_name': project_name, 'steps': {}}
+
+    return state
+
+
+def save_state(state):
+    """Write the step journal."""
+    path = Path(STATE_FILE + '.tmp')
+    path.write_text(json.dumps(state, indent=4, sort_keys=True))
+    path.replace(STATE_FILE)
 
 
 def create_boto_session():
@@ -343,6 +2541,8 @@ def create_boto_session():
     if not profile_names:
         click.echo('Error: Set up the ~/.aws/credentials file.')
         exit(1)
+    elif os.environ.get('AWS_PROFILE') in profiles:
+        profile_name = os.environ['AWS_PROFILE']
     elif len(profile_names) == 1:
         profile_name = profile_names[0]
         click.echo("Okay, using profile {}!".format(
@@ -370,17 +2570,25 @@ def create_boto_session():
     return session
 
 
-def create_zappa_settings(project_name, role_info, session):
-    """Create the zappa_settings.json file."""
+def create_zappa_settings(project_name, role_info, session, s3_bucket=None,
+                          stage='dev', capacity=None, keep_tuned=True):
+    """Create the zappa_settings.json file.
+
+    Only the settings of ``stage`` are replaced, those of other stages,
+    such as the other regions of a multi-region run, are kept. So are the
+    values of the stage that later steps add, see ZAPPA_KEPT_SETTINGS, as
+    a resumed run does not repeat those steps, and with ``keep_tuned`` a
+    memory size written by the tune command.
+    """
+    capacity = capacity or stage_profile(stage)
     zappa = {
-        'dev': {
+        stage: {
             'project_name': project_name,
             'django_settings': '{0}.settings'.format(project_name),
             'profile_name': session.profile_name,
             'profile-region': session.region_name,
-            's3_bucket': 'zappa-{}'.format(''.join(
-                random.choices(string.ascii_lowercase + string.digits, k=9))
-            ),
+            'aws_region': session.region_name,
+            's3_bucket': s3_bucket or create_s3_bucket_name(),
             'runtime': 'python3.6',
             'timeout_seconds': 300,
             'use_precompiled_packages': True,
@@ -392,62 +2600,239 @@ def create_zappa_settings(project_name, role_info, session):
             'vpc_config': {
                 'SubnetIds': role_info['subnet_ids'],
                 'SecurityGroupIds': (role_info['security_group'],)
-            }
+            },
+            'memory_size': capacity['memory_size'],
+            'keep_warm': bool(capacity['keep_warm_interval'])
         }
     }
+    if capacity['keep_warm_interval']:
+        zappa[stage]['keep_warm_expression'] = 'rate({} minute{})'.format(
+            capacity['keep_warm_interval'],
+            's' if capacity['keep_warm_interval'] > 1 else ''
+        )
 
-    zappa['dev']['s3_bucket'] = 'zappa-{}'.format(
-        ''.join(random.choices(string.ascii_lowercase + string.digits, k=9)))
-
-    with open('zappa_settings.json', 'w') as file:
-        file.write(json.dumps(zappa, indent=4, sort_keys=True))
+    with edit_zappa_settings() as settings:
+        previous = settings.get(stage, {})
+        if previous.get('project_name') == project_name:
+            zappa[stage].update(
+                (key, previous[key]) for key in ZAPPA_KEPT_SETTINGS
+                if key in previous)
+            tuned = previous.get(ZAPPA_TUNED_MEMORY)
+            if keep_tuned and tuned and tuned == previous.get('memory_size'):
+                zappa[stage]['memory_size'] = tuned
+                zappa[stage][ZAPPA_TUNED_MEMORY] = tuned
+        settings.update(zappa)
 
     return zappa
 
 
-def create_stack(project_name, role_info, password, session):
+@contextmanager
+def edit_zappa_settings():
+    """Edit zappa_settings.json, one thread at a time.
+
+    Yields the settings, empty when there is no file yet, and writes them
+    back through a temporary file so Zappa never reads half a file.
+    """
+    with ZAPPA_SETTINGS_LOCK:
+        try:
+            zappa = json.loads(Path('zappa_settings.json').read_text())
+        except FileNotFoundError:
+            zappa = {}
+        yield zappa
+        path = Path('zappa_settings.json.tmp')
+        path.write_text(json.dumps(zappa, indent=4, sort_keys=True))
+        path.replace('zappa_settings.json')
+
+
+def stage_profile(stage, **overrides):
+    """Get the capacity profile of a stage with overrides applied.
+
+    Overrides that are None keep the stage's value. Raises
+    click.BadParameter for values Lambda would not accept.
+    """
+    capacity = dict(STAGE_PROFILES[stage])
+    capacity.update(
+        (key, value) for key, value in overrides.items() if value is not None)
+
+    if not 128 <= capacity['memory_size'] <= 10240:
+        raise click.BadParameter(
+            'memory size must be between 128 and 10240 MB.',
+            param_hint='--memory-size')
+    if capacity['keep_warm_interval'] < 0:
+        raise click.BadParameter(
+            'keep-warm interval must be 0 or more minutes.',
+            param_hint='--keep-warm-interval')
+    if (capacity['reserved_concurrency'] is not None and
+            capacity['reserved_concurrency'] < 1):
+        raise click.BadParameter(
+            'reserved concurrency must be at least 1.',
+            param_hint='--reserved-concurrency')
+    if not 20 <= capacity['db_allocated_storage'] <= 65536:
+        raise click.BadParameter(
+            'allocated storage must be between 20 and 65536 GB.',
+            param_hint='--db-allocated-storage')
+    if (capacity['db_storage_type'] == 'io1') != bool(capacity['db_iops']):
+        raise click.BadParameter(
+            'io1 storage needs provisioned IOPS, other types take none.',
+            param_hint='--db-iops')
+    if not 0 <= capacity['db_read_replicas'] <= 5:
+        raise click.BadParameter(
+            'there can be 0 to 5 read replicas.',
+            param_hint='--db-read-replicas')
+    if not capacity['cache_node_type'].startswith('cache.'):
+        raise click.BadParameter(
+            'cache node types look like cache.t3.small.',
+            param_hint='--cache-node-type')
+    if not re.match(r'^\d+(\.\d+)+$', capacity['db_engine_version']):
+        raise click.BadParameter(
+            'engine version must look like 10.10.',
+            param_hint='--db-engine-version')
+
+    return capacity
+
+
+def create_s3_bucket_name():
+    """Create a random name for the Zappa deployment bucket."""
+    return 'zappa-{}'.format(
+        ''.join(random.choices(string.ascii_lowercase + string.digits, k=9)))
+
+
+def create_stack(project_name, role_info, password, session,
+                 connection_pooling=False, capacity=None, cdn=False,
+                 cache=False, name_suffix='', database=True):
     """Create Postgres RDS instance using troposphere."""
     stack_name = '{}-Zappa-RDS-S3'.format(stringcase.pascalcase(project_name))
 
+    t = rds_template(project_name, role_info, password, connection_pooling,
+                     capacity, cdn, cache, name_suffix, database)
+
+    if connection_pooling and database:
+        submit_stack(stack_name, t, session, Capabilities=['CAPABILITY_IAM'])
+    else:
+        submit_stack(stack_name, t, session)
+
+    return stack_name
+
+
+def rds_template(project_name, role_info, password, connection_pooling=False,
+                 capacity=None, cdn=False, cache=False, name_suffix='',
+                 database=True):
+    """Build the template of the RDS instance and the S3 bucket.
+
+    The instance is sized by the db_* values of ``capacity`` and gets a
+    parameter group tuned to the memory of its class, see
+    db_parameters(). With ``connection_pooling`` an RDS Proxy is put in
+    front of the instance. It logs in with a Secrets Manager secret
+    holding the master credentials and its endpoint is output as
+    AwsRdsProxyHost. With ``cdn`` the bucket is put behind CloudFront and
+    with ``cache`` a Redis cluster is added. ``name_suffix`` is added to
+    the name of the bucket, which is global, when there is a stack in more
+    than one region. Without ``database`` the project uses a shared RDS
+    instance and the template leaves its own out.
+    """
+    capacity = capacity or stage_profile('dev')
+
     t = Template()
 
-    t.add_description("RDS PostgreSQL DB instance for Zappa Django project.")
+    t.set_description("RDS PostgreSQL DB instance for Zappa Django project.")
+
+    bucket = t.add_resource(Bucket(
+        '{}S3Zappa'.format(stringcase.pascalcase(project_name)),
+        BucketName='zappa-{}{}'.format(
+            stringcase.spinalcase(project_name), name_suffix),
+        CorsConfiguration=CorsConfiguration(
+            CorsRules=[CorsRules(
+                AllowedHeaders=["Authorization"],
+                AllowedMethods=["GET"],
+                AllowedOrigins=["*"],
+                MaxAge=3000
+            )],
+        ),
+        AccessControl=PublicRead
+    ))
+
+    if database:
+        add_database(t, project_name, role_info, password, capacity,
+                     connection_pooling)
+
+    if cdn:
+        add_cloudfront(t, project_name, bucket)
+
+    if cache:
+        add_redis(t, project_name, role_info, capacity['cache_node_type'])
+
+    return t
+
+
+def add_redis(t, project_name, role_info, node_type):
+    """Add a single node ElastiCache Redis cluster to the template.
+
+    The cluster uses the subnets and the security group of the Lambda
+    function, which the role stack opens to itself on the Redis port. Its
+    host is output as AwsRedisHost.
+    """
+    subnet_group = t.add_resource(CacheSubnetGroup(
+        'ZappaCacheSubnetGroup{}'.format(stringcase.pascalcase(project_name)),
+        Description='Subnets available for the Redis cluster',
+        SubnetIds=role_info['subnet_ids']
+    ))
+
+    cluster = t.add_resource(CacheCluster(
+        '{}ZappaRedis'.format(stringcase.pascalcase(project_name)),
+        Engine='redis',
+        CacheNodeType=node_type,
+        NumCacheNodes=1,
+        CacheSubnetGroupName=Ref(subnet_group),
+        VpcSecurityGroupIds=[role_info['security_group']]
+    ))
+
+    t.add_output(Output(
+        'AwsRedisHost',
+        Description='AWS REDIS HOST',
+        Value=GetAtt(cluster, 'RedisEndpoint.Address')
+    ))
+
 
+def add_database(t, project_name, role_info, password, capacity,
+                 connection_pooling=False):
+    """Add the RDS instance, its replicas and its proxy to the template."""
     dbsubnetgroup = t.add_resource(DBSubnetGroup(
         'ZappaDBSubnetGroup{}'.format(stringcase.pascalcase(project_name)),
         DBSubnetGroupDescription="Subnets available for the RDS DB Instance",
         SubnetIds=role_info['subnet_ids'],
     ))
 
+    parameter_group = t.add_resource(DBParameterGroup(
+        'ZappaDBParameterGroup{}'.format(stringcase.pascalcase(project_name)),
+        Description="Postgres parameters for {}".format(
+            capacity['db_instance_class']),
+        Family=db_parameter_family(capacity['db_engine_version']),
+        Parameters=db_parameters(capacity['db_instance_class'])
+    ))
+
+    # Without a deletion policy CloudFormation keeps a final snapshot, which
+    # destroy would leave behind.
     db_instance = t.add_resource(DBInstance(
         '{}Zappa'.format(stringcase.pascalcase(project_name)),
-        AllocatedStorage="20",
-        DBInstanceClass="db.t2.micro",
+        DeletionPolicy='Delete',
+        AllocatedStorage=str(capacity['db_allocated_storage']),
+        DBInstanceClass=capacity['db_instance_class'],
+        StorageType=capacity['db_storage_type'],
         Engine="postgres",
-        EngineVersion="10.4",
+        EngineVersion=capacity['db_engine_version'],
+        MultiAZ=capacity['db_multi_az'],
         DBInstanceIdentifier='Zappa-{}'.format(
             stringcase.pascalcase(project_name)
         ),
         MasterUsername="postgres",
         MasterUserPassword=password,
         PubliclyAccessible=False,
+        DBParameterGroupName=Ref(parameter_group),
         DBSubnetGroupName=Ref(dbsubnetgroup),
         VPCSecurityGroups=[role_info['security_group']]
     ))
-
-    t.add_resource(Bucket(
-        '{}S3Zappa'.format(stringcase.pascalcase(project_name)),
-        BucketName='zappa-{}'.format(stringcase.spinalcase(project_name)),
-        CorsConfiguration=CorsConfiguration(
-            CorsRules=[CorsRules(
-                AllowedHeaders=["Authorization"],
-                AllowedMethods=["GET"],
-                AllowedOrigins=["*"],
-                MaxAge=3000
-            )],
-        ),
-        AccessControl=PublicRead
-    ))
+    if capacity['db_iops']:
+        db_instance.Iops = capacity['db_iops']
 
     t.add_output(Output(
         'AwsRdsHost',
@@ -455,53 +2840,251 @@ def create_stack(project_name, role_info, password, session):
         Value=GetAtt(db_instance, "Endpoint.Address")
     ))
 
-    resource = session.resource('cloudformation')
-    resource.create_stack(
-        StackName=stack_name,
-        TemplateBody=t.to_json()
-    )
+    replicas = [
+        t.add_resource(DBInstance(
+            '{}ZappaReplica{}'.format(
+                stringcase.pascalcase(project_name), number),
+            DeletionPolicy='Delete',
+            SourceDBInstanceIdentifier=Ref(db_instance),
+            DBInstanceClass=capacity['db_instance_class'],
+            Engine="postgres",
+            DBInstanceIdentifier='Zappa-{}-Replica{}'.format(
+                stringcase.pascalcase(project_name), number),
+            PubliclyAccessible=False,
+            DBParameterGroupName=Ref(parameter_group),
+            VPCSecurityGroups=[role_info['security_group']]
+        ))
+        for number in range(1, capacity['db_read_replicas'] + 1)
+    ]
+    if replicas:
+        t.add_output(Output(
+            'AwsRdsReplicaHosts',
+            Description='AWS RDS REPLICA HOSTS',
+            Value=Join(',', [
+                GetAtt(replica, "Endpoint.Address") for replica in replicas
+            ])
+        ))
 
-    return stack_name
+    if connection_pooling:
+        add_rds_proxy(t, project_name, role_info, password, db_instance)
 
 
-def get_aws_rds_host(stack_name, session):
-    """Get the AWS RDS host."""
-    client = session.client('cloudformation')
-    stack_status = None
-    click.echo("Waiting for stack creation..", nl=False)
-    while stack_status != 'CREATE_COMPLETE':
-        click.echo(".", nl=False)
-        time.sleep(30)
-        response = client.describe_stacks(
-            StackName=stack_name
+def add_cloudfront(t, project_name, bucket):
+    """Add a CloudFront distribution of the S3 bucket to the template.
+
+    CloudFront reads the bucket through an origin access identity and
+    compresses what it serves. Objects are cached for a day unless their
+    Cache-Control header says otherwise, up to a year for hashed names.
+    The Origin header is forwarded so that CORS responses are cached per
+    origin. The domain is output as AwsCloudFrontDomain.
+    """
+    identity = t.add_resource(CloudFrontOriginAccessIdentity(
+        '{}ZappaOriginAccessIdentity'.format(
+            stringcase.pascalcase(project_name)),
+        CloudFrontOriginAccessIdentityConfig=(
+            CloudFrontOriginAccessIdentityConfig(
+                Comment='Zappa {} static files'.format(project_name)))
+    ))
+
+    t.add_resource(BucketPolicy(
+        '{}S3ZappaPolicy'.format(stringcase.pascalcase(project_name)),
+        Bucket=Ref(bucket),
+        PolicyDocument=Policy(
+            Statement=[
+                Statement(
+                    Effect=Allow,
+                    Action=[Action('s3', 'GetObject')],
+                    Principal=Principal(
+                        'CanonicalUser',
+                        GetAtt(identity, 'S3CanonicalUserId')),
+                    Resource=[Join('', ['arn:aws:s3:::', Ref(bucket), '/*'])]
+                )
+            ]
         )
-        stack_status = response['Stacks'][0]['StackStatus']
-        if stack_status == 'ROLLBACK_COMPLETE':
-            click.echo('Error - Stack creation failed (Create RDS Stack).')
-            exit(1)
-    click.secho(' done', fg='green')
-    aws_rds_host = response['Stacks'][0]['Outputs'][0]['OutputValue']
+    ))
+
+    distribution = t.add_resource(Distribution(
+        '{}ZappaDistribution'.format(stringcase.pascalcase(project_name)),
+        DistributionConfig=DistributionConfig(
+            Comment='Zappa {} static files'.format(project_name),
+            Enabled=True,
+            HttpVersion='http2',
+            Origins=[Origin(
+                Id='S3Origin',
+                DomainName=GetAtt(bucket, 'RegionalDomainName'),
+                S3OriginConfig=S3OriginConfig(
+                    OriginAccessIdentity=Join('', [
+                        'origin-access-identity/cloudfront/', Ref(identity)
+                    ])
+                )
+            )],
+            DefaultCacheBehavior=DefaultCacheBehavior(
+                TargetOriginId='S3Origin',
+                ViewerProtocolPolicy='redirect-to-https',
+                AllowedMethods=['GET', 'HEAD', 'OPTIONS'],
+                CachedMethods=['GET', 'HEAD', 'OPTIONS'],
+                Compress=True,
+                ForwardedValues=ForwardedValues(
+                    QueryString=False,
+                    Headers=['Origin', 'Access-Control-Request-Headers',
+                             'Access-Control-Request-Method']
+                ),
+                MinTTL=0,
+                DefaultTTL=60 * 60 * 24,
+                MaxTTL=60 * 60 * 24 * 365
+            )
+        )
+    ))
+
+    t.add_output(Output(
+        'AwsCloudFrontDomain',
+        Description='AWS CLOUDFRONT DOMAIN',
+        Value=GetAtt(distribution, 'DomainName')
+    ))
+
+
+def db_parameters(instance_class):
+    """Size the Postgres memory parameters to an RDS instance class.
+
+    max_connections follows the RDS default formula, shared_buffers gets
+    a quarter of the memory and effective_cache_size three quarters.
+    work_mem shares what is left between three sorts per connection, but
+    is at least the Postgres default of 4 MB. Sizes are in the units
+    Postgres uses, 8 kB pages and kB for work_mem.
+    """
+    memory = DB_INSTANCE_MEMORY[instance_class] * 1024 * 1024 * 1024
+    max_connections = min(memory // 9531392, 5000)
+    shared_buffers = memory // 4
+    work_mem = max((memory - shared_buffers) // (max_connections * 3),
+                   4 * 1024 * 1024)
+
+    return {
+        'max_connections': str(max_connections),
+        'shared_buffers': str(shared_buffers // 8192),
+        'effective_cache_size': str(memory * 3 // 4 // 8192),
+        'work_mem': str(work_mem // 1024),
+    }
+
+
+def db_parameter_family(version):
+    """Get the parameter group family of a PostgreSQL version."""
+    if engine_version(version) < (10,):
+        return 'postgres{}.{}'.format(*engine_version(version)[:2])
+    return 'postgres{}'.format(engine_version(version)[0])
+
+
+def engine_version(version):
+    """Split a PostgreSQL version into a tuple of numbers."""
+    return tuple(int(part) for part in version.split('.'))
+
+
+def add_rds_proxy(t, project_name, role_info, password, db_instance):
+    """Add an RDS Proxy for the DB instance to the template."""
+    secret = t.add_resource(Secret(
+        '{}ZappaDBSecret'.format(stringcase.pascalcase(project_name)),
+        Description='Postgres credentials of the RDS Proxy',
+        SecretString=json.dumps({
+            'username': 'postgres',
+            'password': password
+        })
+    ))
+
+    role = t.add_resource(IAM_Role(
+        '{}ZappaDBProxyRole'.format(stringcase.pascalcase(project_name)),
+        AssumeRolePolicyDocument=Policy(
+            Statement=[
+                Statement(
+                    Effect=Allow,
+                    Action=[AssumeRole],
+                    Principal=Principal("Service", ["rds.amazonaws.com"])
+                )
+            ]
+        ),
+        Policies=[IAM_Policy(
+            PolicyName="{}-DBProxy-Policy".format(project_name),
+            PolicyDocument=Policy(
+                Statement=[
+                    Statement(
+                        Effect="Allow",
+                        Action=[
+                            Action('secretsmanager', 'GetSecretValue')
+                        ],
+                        Resource=[Ref(secret)]
+                    ),
+                ]
+            )
+        )]
+    ))
+
+    proxy = t.add_resource(DBProxy(
+        '{}ZappaDBProxy'.format(stringcase.pascalcase(project_name)),
+        DBProxyName='zappa-{}'.format(stringcase.spinalcase(project_name)),
+        EngineFamily='POSTGRESQL',
+        Auth=[AuthFormat(
+            AuthScheme='SECRETS',
+            IAMAuth='DISABLED',
+            SecretArn=Ref(secret)
+        )],
+        RoleArn=GetAtt(role, 'Arn'),
+        VpcSubnetIds=role_info['subnet_ids'],
+        VpcSecurityGroupIds=[role_info['security_group']],
+        RequireTLS=False,
+        IdleClientTimeout=1800
+    ))
+
+    t.add_resource(DBProxyTargetGroup(
+        '{}ZappaDBProxyTargets'.format(stringcase.pascalcase(project_name)),
+        DBProxyName=Ref(proxy),
+        TargetGroupName='default',
+        DBInstanceIdentifiers=[Ref(db_instance)],
+        ConnectionPoolConfigurationInfo=ConnectionPoolConfigurationInfoFormat(
+            MaxConnectionsPercent=90,
+            MaxIdleConnectionsPercent=50,
+            ConnectionBorrowTimeout=120
+        )
+    ))
+
+    t.add_output(Output(
+        'AwsRdsProxyHost',
+        Description='AWS RDS PROXY HOST',
+        Value=GetAtt(proxy, 'Endpoint')
+    ))
+
+
+def get_aws_rds_host(stack_name, session, env_file='.env',
+                     db_stack_name=None):
+    """Get the AWS RDS host and add it to .env.
+
+    The other stack outputs are added as well. A multi-region run keeps
+    the outputs of each region in an ``env_file`` of its own. With
+    ``db_stack_name`` the RDS outputs come from that shared stack.
+    """
+    outputs = {}
+    for name in filter(None, (db_stack_name, stack_name)):
+        stack = wait_for_stack(
+            name, session, 'Create RDS Stack', max_delay=30)
+        outputs.update(
+            (output['OutputKey'], output['OutputValue'])
+            for output in stack['Outputs']
+        )
+    aws_rds_host = outputs['AwsRdsHost']
+
+    for key, output in (('AWS_RDS_HOST', 'AwsRdsHost'),
+                        ('AWS_RDS_PROXY_HOST', 'AwsRdsProxyHost'),
+                        ('AWS_RDS_REPLICA_HOSTS', 'AwsRdsReplicaHosts'),
+                        ('AWS_REDIS_HOST', 'AwsRedisHost'),
+                        ('AWS_CLOUDFRONT_DOMAIN', 'AwsCloudFrontDomain')):
+        if output in outputs:
+            update_env_file(key, outputs[output], env_file)
 
     return aws_rds_host
 
 
 def get_role_name(stack_name, session):
     """Get Role name."""
-    client = session.client('cloudformation')
-    stack_status = None
-    click.echo("Waiting for stack creation..", nl=False)
-    while stack_status != 'CREATE_COMPLETE':
-        click.echo(".", nl=False)
-        time.sleep(30)
-        response = client.describe_stacks(
-            StackName=stack_name
-        )
-        stack_status = response['Stacks'][0]['StackStatus']
-        if stack_status == 'ROLLBACK_COMPLETE':
-            click.echo('Error - Stack creation failed (Create Role Stack).')
-            exit(1)
-    click.secho(' done', fg='green')
-    outputs = response['Stacks'][0]['Outputs']
+    stack = wait_for_stack(
+        stack_name, session, 'Create Role Stack', max_delay=10)
+    outputs = stack['Outputs']
 
     role_name = ''
     security_group = ''
@@ -522,83 +3105,221 @@ def get_role_name(stack_name, session):
     }
 
 
-def deploy_zappa(project_name, client):
+def wait_for_stack(stack_name, session, description, delay=2,
+                   max_delay=30, backoff=1.5, operation='create',
+                   last_event_id=None):
+    """Wait for a CloudFormation stack to be created.
+
+    Polls with a delay that starts at ``delay`` seconds and grows by
+    ``backoff`` up to ``max_delay``, printing new stack events as they
+    arrive together with the time each resource took. Any status other
+    than CREATE_IN_PROGRESS or CREATE_COMPLETE is a failure and reports
+    the resources that failed. Returns the stack description.
+
+    With an ``operation`` of ``'delete'`` it waits for DELETE_COMPLETE
+    instead, ``stack_name`` then has to be the stack id as a deleted
+    stack can no longer be described by name. Events up to
+    ``last_event_id`` are not printed.
+    """
+    client = session.client('cloudformation')
+    started = {}
+    failures = []
+    status_prefix = operation.upper()
+    noun = {'create': 'creation', 'delete': 'deletion'}[operation]
+    click.echo('Waiting for stack {} ({})...'.format(noun, description))
+    while True:
+        stack = client.describe_stacks(StackName=stack_name)['Stacks'][0]
+        events = get_new_stack_events(client, stack_name, last_event_id)
+        for event in events:
+            last_event_id = event['EventId']
+            resource = event['LogicalResourceId']
+            status = event['ResourceStatus']
+            timestamp = event['Timestamp']
+            if status.endswith('_IN_PROGRESS'):
+                started.setdefault(resource, timestamp)
+                continue
+            if status.endswith('_FAILED'):
+                failures.append(event)
+            elapsed = ''
+            if resource in started:
+                elapsed = ' ({})'.format(format_duration(
+                    (timestamp - started[resource]).total_seconds()))
+            click.echo('  {} {} {}{}'.format(
+                resource, event['ResourceType'], status, elapsed))
+
+        stack_status = stack['StackStatus']
+        if stack_status == status_prefix + '_COMPLETE':
+            break
+        if stack_status != status_prefix + '_IN_PROGRESS':
+            click.echo('Error - Stack {} failed ({}): {}.'.format(
+                noun, description, stack_status))
+            for event in failures:
+                click.echo('  {} ({}): {}'.format(
+                    event['LogicalResourceId'],
+                    event['ResourceType'],
+                    event.get('ResourceStatusReason', 'no reason given')
+                ))
+            exit(1)
+        sleep(delay)
+        delay = min(delay * backoff, max_delay)
+    click.secho('... done', fg='green')
+
+    return stack
+
+
+def get_new_stack_events(client, stack_name, last_event_id):
+    """Get the stack events newer than ``last_event_id``, oldest first.
+
+    CloudFormation returns events newest first, so pages are only fetched
+    until the last event already seen turns up.
+    """
+    events = []
+    paginator = client.get_paginator('describe_stack_events')
+    for page in paginator.paginate(StackName=stack_name):
+        for event in page['StackEvents']:
+            if event['EventId'] == last_event_id:
+                return list(reversed(events))
+            events.append(event)
+
+    return list(reversed(events))
+
+
+def format_duration(seconds):
+    """Format a number of seconds as minutes and seconds."""
+    return '{}m{:02d}s'.format(*divmod(int(seconds), 60))
+
+
+def deploy_zappa(run, stage='dev'):
     """Deploy to AWS Lambda using Zappa."""
     click.echo(
         'Deploying Django project on AWS Lambda using Zappa...', nl=False)
     try:
-        client.containers.run(
-            '{}_web:latest'.format(project_name),
-            '/bin/bash -c "source ve/bin/activate && zappa deploy dev"',
-            remove=True,
-            volumes={
-                Path.cwd(): {'bind': '/var/task', 'mode': 'rw'},
-                '{}/.aws'.format(Path.home()): {
-                    'bind': '/root/.aws',
-                    'mode': 'ro'
-                }
-            }
-        )
+        with phase('deploy'):
+            run('/bin/bash -c "source ve/bin/activate \
+                && zappa deploy {}"'.format(stage))
     except docker.errors.ContainerError:
         pass
     click.secho(' done', fg='green')
 
-    return get_lambda_host(project_name, client)
-
 
-def update_zappa(project_name, client):
-    """Deploy to AWS Lambda using Zappa."""
+def undeploy_zappa(project_name, run, session, stage='dev'):
+    """Undeploy a stage using Zappa, unless it is already gone."""
+    client = session.client('lambda')
+    try:
+        client.get_function(
+            FunctionName=get_lambda_function_name(project_name, stage))
+    except client.exceptions.ResourceNotFoundException:
+        click.echo('Zappa stage {} is not deployed.'.format(stage))
+        return
+    click.echo('Undeploying Zappa stage {}...'.format(stage))
+    with phase('undeploy'):
+        run('/bin/bash -c "source ve/bin/activate \
+            && zappa undeploy {} --yes --remove-logs"'.format(stage))
+    click.secho('... {} undeployed'.format(stage), fg='green')
+
+
+def update_zappa(project_name, aws_lambda_host, session, stage='dev'):
+    """Add the Lambda host to ALLOWED_HOSTS of the Zappa deployment.
+
+    The host is set as an environment variable of the deployed function,
+    which takes precedence over .env, so the package does not have to be
+    built and uploaded a second time. It is also added to the
+    aws_environment_variables of zappa_settings.json so that later
+    ``zappa update`` runs keep it.
+    """
     click.echo(
         'Updating Zappa deployment to add Lambda host to ALLOWED_HOSTS...',
         nl=False
     )
-    try:
-        client.containers.run(
-            '{}_web:latest'.format(project_name),
-            '/bin/bash -c "source ve/bin/activate && zappa update dev"',
-            remove=True,
-            volumes={
-                Path.cwd(): {'bind': '/var/task', 'mode': 'rw'},
-                '{}/.aws'.format(Path.home()): {
-                    'bind': '/root/.aws',
-                    'mode': 'ro'
-                }
-            }
+    with phase('update'):
+        client = session.client('lambda')
+        function_name = get_lambda_function_name(project_name, stage)
+        configuration = client.get_function_configuration(
+            FunctionName=function_name)
+        variables = configuration.get(
+            'Environment', {}).get('Variables', {})
+        variables['AWS_LAMBDA_HOST'] = aws_lambda_host
+        client.update_function_configuration(
+            FunctionName=function_name,
+            Environment={'Variables': variables}
         )
-    except docker.errors.ContainerError:
-        pass
+
+    with edit_zappa_settings() as zappa:
+        zappa[stage].setdefault('aws_environment_variables', {})[
+            'AWS_LAMBDA_HOST'] = aws_lambda_host
     click.secho(' done', fg='green')
 
 
-def get_lambda_host(project_name, client):
-    """Get Lambda host."""
-    output = client.containers.run(
-        '{}_web:latest'.format(project_name),
-        '/bin/bash -c "source ve/bin/activate && zappa status dev"',
-        remove=True,
-        volumes={
-            Path.cwd(): {'bind': '/var/task', 'mode': 'rw'},
-            '{}/.aws'.format(Path.home()): {
-                'bind': '/root/.aws',
-                'mode': 'ro'
-            }
-        }
-    )
+def region_stage_name(stage, region):
+    """Get the Zappa stage of a region in a multi-region run.
+
+    API Gateway stage names only take letters, digits and underscores.
+    """
+    return '{}_{}'.format(stage, region.replace('-', '_'))
+
 
-    for line in output.split(b'\n'):
-        tokens = line.split(b': ')
-        if tokens[0] == b'\tAPI Gateway URL':
-            aws_lambda_host = urlparse(
-                tokens[1].decode('utf-8').replace(' ', '')
-            ).netloc
-            return aws_lambda_host
+def get_lambda_function_name(project_name, stage='dev'):
+    """Get the name Zappa gives the Lambda function of a stage."""
+    return re.sub(
+        r'[^-a-z0-9]+', '-', '{}-{}'.format(project_name, stage).lower()
+    ).strip('-')
 
 
-def create_role(project_name, session):
+def get_lambda_host(project_name, session, stage='dev'):
+    """Get Lambda host.
+
+    Zappa names the API Gateway REST API after the Lambda function, so the
+    host is found by looking up the newest API of that name that has the
+    stage deployed.
+    """
+    client = session.client('apigateway')
+    api_name = get_lambda_function_name(project_name, stage)
+    apis = [
+        api
+        for page in client.get_paginator('get_rest_apis').paginate()
+        for api in page['items']
+        if api['name'] == api_name
+    ]
+    apis.sort(key=lambda api: api['createdDate'], reverse=True)
+    for api in apis:
+        stages = client.get_stages(restApiId=api['id'])['item']
+        if any(item['stageName'] == stage for item in stages):
+            return '{}.execute-api.{}.amazonaws.com'.format(
+                api['id'], client.meta.region_name)
+
+    click.echo('Error - API Gateway {} has no {} stage.'.format(
+        api_name, stage))
+    exit(1)
+
+
+def create_role(project_name, session, vpc_endpoints=(), name_suffix=''):
     """Create role."""
+    t = role_template(project_name, availability_zones(session),
+                      vpc_endpoints, name_suffix)
+
+    stack_name = '{}-Zappa-Role-VPC-SG'.format(
+        stringcase.pascalcase(project_name)
+    )
+
+    submit_stack(stack_name, t, session,
+                 Capabilities=['CAPABILITY_NAMED_IAM'])
+
+    return stack_name
+
+
+def role_template(project_name, zones, vpc_endpoints=(), name_suffix=''):
+    """Build the template of the role, VPC, subnets and security group.
+
+    There is a subnet in each of ``zones``, with CIDR blocks allocated
+    from VPC_CIDR. The subnets share a route table with a gateway
+    endpoint for S3, so the Lambda function reaches the bucket without a
+    NAT gateway. Each of ``vpc_endpoints`` adds an interface endpoint for
+    that AWS service. ``name_suffix`` is added to the name of the role,
+    which is global, when there is a stack in more than one region.
+    """
     t = Template()
 
-    t.add_description("AWS Role, VPC, Security Group, and Subnet for Zappa.")
+    t.set_description("AWS Role, VPC, Security Group, and Subnet for Zappa.")
 
     policy = IAM_Policy(
         PolicyName="{}-Policy".format(project_name),
@@ -653,7 +3374,8 @@ def create_role(project_name, session):
 
     role = t.add_resource(IAM_Role(
         'ZappaRole{}'.format(stringcase.pascalcase(project_name)),
-        RoleName='ZappaRole{}'.format(stringcase.pascalcase(project_name)),
+        RoleName='ZappaRole{}{}'.format(
+            stringcase.pascalcase(project_name), name_suffix),
         AssumeRolePolicyDocument=Policy(
             Statement=[
                 Statement(
@@ -677,7 +3399,7 @@ def create_role(project_name, session):
     myVpc = t.add_resource(
         ec2.VPC(
             'VPC{}'.format(stringcase.pascalcase(project_name)),
-            CidrBlock='172.31.0.0/16',
+            CidrBlock=VPC_CIDR,
             Tags=Tags(
                 Name='ZappaVPC{}'.format(
                     stringcase.pascalcase(project_name)
@@ -686,33 +3408,24 @@ def create_role(project_name, session):
         )
     )
 
-    subnet_1 = t.add_resource(
-        ec2.Subnet(
-            'ZappaSubnet1{}'.format(stringcase.pascalcase(project_name)),
-            CidrBlock='172.31.0.0/20',
-            AvailabilityZone='us-east-1a',
-            VpcId=Ref(myVpc),
-            Tags=Tags(
-                Name='ZappaSubnet1{}'.format(
-                    stringcase.pascalcase(project_name)
-                ),
-            )
-        )
-    )
-
-    subnet_2 = t.add_resource(
-        ec2.Subnet(
-            'ZappaSubnet2{}'.format(stringcase.pascalcase(project_name)),
-            CidrBlock='172.31.16.0/20',
-            AvailabilityZone='us-east-1b',
-            VpcId=Ref(myVpc),
-            Tags=Tags(
-                Name='ZappaSubnet2{}'.format(
-                    stringcase.pascalcase(project_name)
-                ),
+    subnets = [
+        t.add_resource(
+            ec2.Subnet(
+                'ZappaSubnet{}{}'.format(
+                    number, stringcase.pascalcase(project_name)),
+                CidrBlock=cidr,
+                AvailabilityZone=zone,
+                VpcId=Ref(myVpc),
+                Tags=Tags(
+                    Name='ZappaSubnet{}{}'.format(
+                        number, stringcase.pascalcase(project_name)
+                    ),
+                )
             )
         )
-    )
+        for number, (zone, cidr) in enumerate(
+            zip(zones, subnet_cidrs(VPC_CIDR, len(zones))), 1)
+    ]
 
     security_group = t.add_resource(
         ec2.SecurityGroup(
@@ -739,6 +3452,16 @@ def create_role(project_name, session):
             DependsOn='ZappaSG{}'.format(stringcase.pascalcase(project_name)),
         )
     )
+    # The Redis port is opened here rather than in the RDS stack, where
+    # the projects sharing the security group would each add the rule.
+    t.add_resource(ec2.SecurityGroupIngress(
+        '{}RedisIngress'.format(stringcase.pascalcase(project_name)),
+        GroupId=Ref(security_group),
+        IpProtocol='tcp',
+        FromPort='6379',
+        ToPort='6379',
+        SourceSecurityGroupId=Ref(security_group)
+    ))
 
     t.add_output(Output(
         'RoleName',
@@ -752,31 +3475,151 @@ def create_role(project_name, session):
         Value=GetAtt(security_group, "GroupId")
     ))
 
-    t.add_output(Output(
-        'SubnetId1',
-        Description='SubnetId',
-        Value=Ref(subnet_1)
+    for number, subnet in enumerate(subnets, 1):
+        t.add_output(Output(
+            'SubnetId{}'.format(number),
+            Description='SubnetId',
+            Value=Ref(subnet)
+        ))
+
+    add_vpc_endpoints(t, project_name, myVpc, subnets, security_group,
+                      vpc_endpoints)
+
+    return t
+
+
+def availability_zones(session, count=2):
+    """Get the first availability zones of the session's region."""
+    response = session.client('ec2').describe_availability_zones(Filters=[
+        {'Name': 'state', 'Values': ['available']},
+        {'Name': 'zone-type', 'Values': ['availability-zone']},
+    ])
+    zones = sorted(zone['ZoneName'] for zone in response['AvailabilityZones'])
+    if len(zones) < count:
+        click.echo('Error - {} has {} availability zones, {} are needed.'
+                   .format(session.region_name, len(zones), count))
+        exit(1)
+
+    return zones[:count]
+
+
+def subnet_cidrs(vpc_cidr, count, prefix=20):
+    """Allocate ``count`` consecutive subnet CIDR blocks in a VPC."""
+    subnets = ipaddress.ip_network(vpc_cidr).subnets(new_prefix=prefix)
+    return [str(next(subnets)) for number in range(count)]
+
+
+def add_vpc_endpoints(t, project_name, vpc, subnets, security_group,
+                      services=()):
+    """Add a route table with an S3 gateway endpoint to the template.
+
+    Interface endpoints of ``services`` are put in the subnets with
+    private DNS, so the AWS SDK reaches them under the usual host names.
+    The security group is opened to itself for their HTTPS traffic.
+    """
+    route_table = t.add_resource(ec2.RouteTable(
+        'ZappaRouteTable{}'.format(stringcase.pascalcase(project_name)),
+        VpcId=Ref(vpc),
+        Tags=Tags(
+            Name='ZappaRouteTable{}'.format(
+                stringcase.pascalcase(project_name)
+            ),
+        )
     ))
 
-    t.add_output(Output(
-        'SubnetId2',
-        Description='SubnetId',
-        Value=Ref(subnet_2)
+    for number, subnet in enumerate(subnets, 1):
+        t.add_resource(ec2.SubnetRouteTableAssociation(
+            'ZappaSubnet{}RouteTable{}'.format(
+                number, stringcase.pascalcase(project_name)),
+            RouteTableId=Ref(route_table),
+            SubnetId=Ref(subnet)
+        ))
+
+    t.add_resource(ec2.VPCEndpoint(
+        'ZappaS3Endpoint{}'.format(stringcase.pascalcase(project_name)),
+        ServiceName=Join('', ['com.amazonaws.', Ref('AWS::Region'), '.s3']),
+        VpcEndpointType='Gateway',
+        VpcId=Ref(vpc),
+        RouteTableIds=[Ref(route_table)]
     ))
 
-    stack_name = '{}-Zappa-Role-VPC-SG'.format(
-        stringcase.pascalcase(project_name)
-    )
+    if not services:
+        return
 
-    resource = session.resource('cloudformation')
-    resource.create_stack(
-        StackName=stack_name,
-        TemplateBody=t.to_json(),
-        Capabilities=['CAPABILITY_NAMED_IAM']
-    )
+    vpc.EnableDnsSupport = True
+    vpc.EnableDnsHostnames = True
 
-    return stack_name
+    t.add_resource(ec2.SecurityGroupIngress(
+        '{}HttpsIngress'.format(stringcase.pascalcase(project_name)),
+        GroupId=Ref(security_group),
+        IpProtocol='tcp',
+        FromPort='443',
+        ToPort='443',
+        SourceSecurityGroupId=Ref(security_group)
+    ))
+
+    for service in services:
+        t.add_resource(ec2.VPCEndpoint(
+            'Zappa{}Endpoint{}'.format(
+                stringcase.pascalcase(service),
+                stringcase.pascalcase(project_name)),
+            ServiceName=Join('', [
+                'com.amazonaws.', Ref('AWS::Region'), '.', service]),
+            VpcEndpointType='Interface',
+            VpcId=Ref(vpc),
+            SubnetIds=[Ref(subnet) for subnet in subnets],
+            SecurityGroupIds=[Ref(security_group)],
+            PrivateDnsEnabled=True
+        ))
+
+
+def submit_stack(stack_name, template, session, **kwargs):
+    """Create a CloudFormation stack unless an earlier run already did."""
+    client = session.client('cloudformation')
+    try:
+        client.create_stack(
+            StackName=stack_name,
+            TemplateBody=template.to_json(),
+            **kwargs
+        )
+    except client.exceptions.AlreadyExistsException:
+        click.echo('Stack {} already exists.'.format(stack_name))
+
+
+def stack_buckets(stack_name, session):
+    """Get the names of the S3 buckets of a stack, if it exists."""
+    client = session.client('cloudformation')
+    try:
+        return [
+            resource['PhysicalResourceId']
+            for page in client.get_paginator(
+                'list_stack_resources').paginate(StackName=stack_name)
+            for resource in page['StackResourceSummaries']
+            if resource['ResourceType'] == 'AWS::S3::Bucket'
+        ]
+    except botocore.exceptions.ClientError as error:
+        if 'does not exist' not in error.response['Error']['Message']:
+            raise
+        return []
+
+
+def delete_stack(stack_name, session, description):
+    """Delete a CloudFormation stack and wait until it is gone."""
+    client = session.client('cloudformation')
+    try:
+        stack = client.describe_stacks(StackName=stack_name)['Stacks'][0]
+    except botocore.exceptions.ClientError as error:
+        if 'does not exist' not in error.response['Error']['Message']:
+            raise
+        click.echo('Stack {} does not exist.'.format(stack_name))
+        return None
+    events = client.describe_stack_events(StackName=stack['StackId'])
+    client.delete_stack(StackName=stack['StackId'])
+
+    return wait_for_stack(
+        stack['StackId'], session, description, operation='delete',
+        last_event_id=events['StackEvents'][0]['EventId'])
 
 
 if __name__ == '__main__':
-    main()
+    cli()
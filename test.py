@@ -1,7 +1,117 @@
 """Test setup.py file."""
+import base64
+import contextlib
+import datetime
+import io
+import json
+import os
+import re
+import shutil
+import sys
+import tarfile
+import tempfile
+import time
 import unittest
+from unittest import mock
 import boto3
-from setup import create_env_file, create_zappa_settings
+import botocore
+import click
+import docker
+from botocore.stub import Stubber
+from click.testing import CliRunner
+import setup
+from setup import (
+    build_image, create_env_file, create_zappa_settings, get_lambda_host,
+    install_requirements, load_state, prune_package, run_bootstrap,
+    run_pipeline, update_zappa, wait_for_postgres, wait_for_stack,
+    worker_runner
+)
+
+
+class StubSession:
+    """boto3 session handing out stubbed clients."""
+
+    def __init__(self):
+        self.clients = {}
+        self.stubbers = {}
+
+    def client(self, service_name, **kwargs):
+        if service_name not in self.clients:
+            client = boto3.Session(region_name='us-east-1').client(
+                service_name)
+            self.clients[service_name] = client
+            self.stubbers[service_name] = Stubber(client)
+            self.stubbers[service_name].activate()
+        return self.clients[service_name]
+
+    def stub(self, service_name):
+        self.client(service_name)
+        return self.stubbers[service_name]
+
+
+class FakeS3:
+    """In-memory stand-in for the S3 client."""
+
+    def __init__(self):
+        self.objects = {}
+
+    def client(self, service_name, **kwargs):
+        return self
+
+    def get_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise botocore.exceptions.ClientError(
+                {'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+        return {'Body': io.BytesIO(self.objects[Bucket, Key]['Body'])}
+
+    def put_object(self, Bucket, Key, **kwargs):
+        self.objects[Bucket, Key] = kwargs
+
+
+@contextlib.contextmanager
+def temporary_directory():
+    """Run inside a new temporary working directory."""
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        try:
+            yield directory
+        finally:
+            os.chdir(cwd)
+
+
+def stack_event(event_id, resource, status, minute, reason=None):
+    """Build a CloudFormation stack event."""
+    event = {
+        'StackId': 'stack-id',
+        'EventId': event_id,
+        'StackName': 'stack',
+        'LogicalResourceId': resource,
+        'ResourceType': 'AWS::RDS::DBInstance',
+        'ResourceStatus': status,
+        'Timestamp': datetime.datetime(2018, 1, 1, 0, minute),
+    }
+    if reason:
+        event['ResourceStatusReason'] = reason
+    return event
+
+
+# Outputs of the role stack, see get_role_name().
+ROLE_INFO = {
+    'role_name': 'role_name',
+    'subnet_ids': ['subnet-1', 'subnet-2'],
+    'security_group': 'sg'
+}
+
+
+def stack_description(status, outputs=()):
+    """Build a CloudFormation stack description."""
+    return {'Stacks': [{
+        'StackName': 'stack',
+        'StackStatus': status,
+        'CreationTime': datetime.datetime(2018, 1, 1),
+        'Outputs': list(outputs),
+    }]}
 
 
 class TestSetup(unittest.TestCase):
@@ -24,6 +134,892 @@ class TestSetup(unittest.TestCase):
         zappa = create_zappa_settings('project_name', role_info, session)
         self.assertEqual(zappa['dev']['project_name'], 'project_name')
 
+    def testRunPipeline(self):
+        """Test independent pipeline steps run in parallel."""
+        def slow(value):
+            def function(results):
+                time.sleep(0.2)
+                return value
+            return function
+
+        start = time.monotonic()
+        results = run_pipeline([
+            ('a', (), slow(1)),
+            ('b', (), slow(2)),
+            ('c', ('a', 'b'), lambda results: results['a'] + results['b']),
+        ])
+        self.assertLess(time.monotonic() - start, 0.4)
+        self.assertEqual(results, {'a': 1, 'b': 2, 'c': 3})
+
+    def testRunPipelineFailure(self):
+        """Test a failing step stops the pipeline."""
+        started = []
+
+        def fail(results):
+            raise RuntimeError('failed')
+
+        with self.assertRaises(RuntimeError):
+            run_pipeline([
+                ('a', (), fail),
+                ('b', ('a',), lambda results: started.append('b')),
+            ])
+        self.assertEqual(started, [])
+
+    @mock.patch('setup.sleep')
+    def testWaitForStack(self, sleep):
+        """Test the stack waiter only reports new events."""
+        session = StubSession()
+        stub = session.stub('cloudformation')
+        stub.add_response('describe_stacks',
+                          stack_description('CREATE_IN_PROGRESS'))
+        stub.add_response('describe_stack_events', {'StackEvents': [
+            stack_event('1', 'DB', 'CREATE_IN_PROGRESS', 0),
+        ]})
+        stub.add_response('describe_stacks', stack_description(
+            'CREATE_COMPLETE',
+            [{'OutputKey': 'AwsRdsHost', 'OutputValue': 'db.example.com'}]
+        ))
+        stub.add_response('describe_stack_events', {'StackEvents': [
+            stack_event('2', 'DB', 'CREATE_COMPLETE', 9),
+            stack_event('1', 'DB', 'CREATE_IN_PROGRESS', 0),
+        ]})
+        stack = wait_for_stack('stack', session, 'test', delay=2)
+        stub.assert_no_pending_responses()
+        self.assertEqual(stack['Outputs'][0]['OutputValue'], 'db.example.com')
+        sleep.assert_called_once_with(2)
+
+    @mock.patch('setup.sleep')
+    def testWaitForStackFailure(self, sleep):
+        """Test the stack waiter fails fast on a failed resource."""
+        session = StubSession()
+        stub = session.stub('cloudformation')
+        stub.add_response('describe_stacks',
+                          stack_description('ROLLBACK_IN_PROGRESS'))
+        stub.add_response('describe_stack_events', {'StackEvents': [
+            stack_event('2', 'DB', 'CREATE_FAILED', 1, 'Bad password'),
+            stack_event('1', 'DB', 'CREATE_IN_PROGRESS', 0),
+        ]})
+        with self.assertRaises(SystemExit):
+            wait_for_stack('stack', session, 'test')
+        sleep.assert_not_called()
+
+    @mock.patch('setup.sleep')
+    @mock.patch('setup.subprocess.run')
+    @mock.patch('setup.socket.create_connection')
+    def testWaitForPostgres(self, create_connection, run, sleep):
+        """Test Postgres readiness backs off until SELECT 1 succeeds."""
+        create_connection.side_effect = [ConnectionRefusedError(),
+                                         mock.DEFAULT, mock.DEFAULT]
+        run.side_effect = [mock.Mock(returncode=2, stdout=b''),
+                           mock.Mock(returncode=0, stdout=b'1\n')]
+        wait_for_postgres(delay=1)
+        self.assertEqual(
+            [call[0][0] for call in sleep.call_args_list], [1, 2])
+
+    def testWorkerRunner(self):
+        """Test the worker container runs commands with exec."""
+        client = mock.Mock()
+        client.api.exec_start.return_value = iter([b'a', b'b'])
+        client.api.exec_inspect.side_effect = [{'ExitCode': 0},
+                                               {'ExitCode': 3}]
+        with self.assertRaises(docker.errors.ContainerError):
+            with worker_runner('project_name', client) as run:
+                self.assertEqual(run('true'), b'ab')
+                client.api.exec_start.return_value = iter([b'error'])
+                run('false', environment={'A': 'B'})
+        container = client.containers.run.return_value
+        client.containers.run.assert_called_once()
+        container.remove.assert_called_once_with(force=True)
+        self.assertEqual(len(run.timings), 2)
+
+    def testInstallRequirementsCache(self):
+        """Test unchanged requirements skip the install."""
+        with temporary_directory():
+            os.mkdir('ve')
+            with open('requirements.txt', 'w') as file:
+                file.write('Django==2.1.2\n')
+            run = mock.Mock()
+            run.side_effect = [
+                b'3.6.8 x86_64\n',
+                docker.errors.ContainerError(None, 1, 'test', '', b''),
+                b'', b'',
+            ]
+            install_requirements(run)
+            self.assertEqual(run.call_count, 4)
+            self.assertIn('mktemp -d', run.call_args_list[2][0][0])
+            self.assertIn('pip install --no-index',
+                          run.call_args_list[3][0][0])
+
+            run = mock.Mock(return_value=b'3.6.8 x86_64\n')
+            install_requirements(run)
+            run.assert_called_once()
+
+    def testBuildImage(self):
+        """Test the image build sends a minimal context and is skipped."""
+        with temporary_directory():
+            os.makedirs('ve/lib')
+            os.mkdir('conf')
+            with open('Dockerfile', 'w') as file:
+                file.write('FROM base\nCOPY conf /etc/conf\n')
+            with open('conf/app.ini', 'w') as file:
+                file.write('[app]\n')
+            client = mock.Mock()
+            client.images.get.side_effect = [
+                mock.Mock(id='sha256:base'),
+                docker.errors.ImageNotFound('missing'),
+            ]
+            build_image('project_name', client)
+            kwargs = client.images.build.call_args[1]
+            names = tarfile.open(fileobj=kwargs['fileobj']).getnames()
+            self.assertEqual(names,
+                             ['Dockerfile', 'conf', 'conf/app.ini'])
+
+            client.images.build.reset_mock()
+            client.images.get.side_effect = [
+                mock.Mock(id='sha256:base'),
+                mock.Mock(labels=kwargs['labels']),
+            ]
+            build_image('project_name', client)
+            client.images.build.assert_not_called()
+
+    def testRunPipelineResume(self):
+        """Test checkpointed steps are skipped when resuming."""
+        with temporary_directory():
+            state = load_state('project_name')
+            run_pipeline([
+                ('a', (), lambda results: 1),
+                ('b', ('a',), lambda results: results['a'] + 1),
+            ], state=state, checkpoints=('a',))
+
+            function = mock.Mock(return_value=5)
+            results = run_pipeline([
+                ('a', (), function),
+                ('b', ('a',), lambda results: results['a'] + 1),
+            ], state=load_state('project_name'), checkpoints=('a',))
+            function.assert_not_called()
+            self.assertEqual(results, {'a': 1, 'b': 2})
+            self.assertEqual(load_state('other')['steps'], {})
+
+    def testZappaSettingsResume(self):
+        """Test resuming keeps the settings the deploy step added."""
+        session = boto3.Session(region_name='eu-west-1')
+
+        def deploy(results):
+            with setup.edit_zappa_settings() as zappa:
+                zappa['dev_eu_west_1']['aws_environment_variables'] = {
+                    'AWS_RDS_HOST': 'db.example.com',
+                    'AWS_LAMBDA_HOST': 'api.example.com',
+                }
+            return 'api.example.com'
+
+        def steps(lambda_host):
+            return [
+                ('zappa_settings', (), lambda results: create_zappa_settings(
+                    'project_name', ROLE_INFO, session, 'bucket',
+                    'dev_eu_west_1', setup.stage_profile('dev'))),
+                ('lambda_host', ('zappa_settings',), lambda_host),
+            ]
+
+        with temporary_directory():
+            run_pipeline(steps(deploy), state=load_state('project_name'),
+                         checkpoints=('lambda_host',))
+            lambda_host = mock.Mock()
+            run_pipeline(steps(lambda_host),
+                         state=load_state('project_name'),
+                         checkpoints=('lambda_host',))
+            with open('zappa_settings.json') as file:
+                zappa = json.load(file)
+        lambda_host.assert_not_called()
+        self.assertEqual(
+            zappa['dev_eu_west_1']['aws_environment_variables'], {
+                'AWS_RDS_HOST': 'db.example.com',
+                'AWS_LAMBDA_HOST': 'api.example.com',
+            })
+
+    def testZappaSettingsTuned(self):
+        """Test rewriting a stage keeps the memory size tune wrote."""
+        session = boto3.Session(region_name='us-east-1')
+        capacity = setup.stage_profile('dev')
+        with temporary_directory():
+            create_zappa_settings('project_name', ROLE_INFO, session,
+                                  'bucket', 'dev', capacity)
+            with setup.edit_zappa_settings() as zappa:
+                zappa['dev']['memory_size'] = 1024
+                zappa['dev']['tuned_memory_size'] = 1024
+            tuned = create_zappa_settings('project_name', ROLE_INFO, session,
+                                          'bucket', 'dev', capacity)
+            overridden = create_zappa_settings(
+                'project_name', ROLE_INFO, session, 'bucket', 'dev',
+                setup.stage_profile('dev', memory_size=2048),
+                keep_tuned=False)
+        self.assertEqual(tuned['dev']['memory_size'], 1024)
+        self.assertEqual(overridden['dev']['memory_size'], 2048)
+        self.assertNotIn('tuned_memory_size', overridden['dev'])
+
+    def testEnvFileResume(self):
+        """Test resuming keeps the generated database password."""
+        session = boto3.Session()
+        with temporary_directory():
+            env = create_env_file('project_name', 'name', 'email', session)
+            previous = dict(env, AWS_RDS_HOST='db.example.com')
+            resumed = create_env_file(
+                'project_name', 'name', 'email', session, previous)
+            self.assertEqual(resumed['DB_PASSWORD'], env['DB_PASSWORD'])
+            self.assertEqual(resumed['AWS_RDS_HOST'], 'db.example.com')
+
+    def testPhaseTrace(self):
+        """Test pipeline steps are traced with their wait time."""
+        del setup.TRACE[:]
+        run_pipeline([('wait', (), lambda results: setup.sleep(0.05))])
+        record, = setup.TRACE
+        self.assertEqual(record['name'], 'wait')
+        self.assertGreaterEqual(record['wait'], 0.05)
+        self.assertGreaterEqual(record['wall'], record['wait'])
+        with temporary_directory():
+            setup.write_chrome_trace('trace.json')
+            with open('trace.json') as file:
+                event, = json.load(file)['traceEvents']
+        self.assertEqual(event['ph'], 'X')
+        self.assertEqual(event['name'], 'wait')
+
+    def testUpdateZappa(self):
+        """Test the Lambda host is set without a new package upload."""
+        session = StubSession()
+        stub = session.stub('lambda')
+        stub.add_response(
+            'get_function_configuration',
+            {'Environment': {'Variables': {'A': 'B'}}},
+            {'FunctionName': 'my-project-dev'}
+        )
+        stub.add_response('update_function_configuration', {}, {
+            'FunctionName': 'my-project-dev',
+            'Environment': {'Variables': {
+                'A': 'B', 'AWS_LAMBDA_HOST': 'api.example.com'
+            }},
+        })
+        with temporary_directory():
+            with open('zappa_settings.json', 'w') as file:
+                json.dump({'dev': {}}, file)
+            update_zappa('my_project', 'api.example.com', session)
+            with open('zappa_settings.json') as file:
+                zappa = json.load(file)
+        stub.assert_no_pending_responses()
+        self.assertEqual(zappa['dev']['aws_environment_variables'],
+                         {'AWS_LAMBDA_HOST': 'api.example.com'})
+
+    def testGetLambdaHost(self):
+        """Test the API Gateway host is found through the AWS API."""
+        session = StubSession()
+        stub = session.stub('apigateway')
+        stub.add_response('get_rest_apis', {'items': [
+            {'id': 'old', 'name': 'my-project-dev',
+             'createdDate': datetime.datetime(2018, 1, 1)},
+            {'id': 'other', 'name': 'other-dev',
+             'createdDate': datetime.datetime(2018, 1, 1)},
+            {'id': 'new', 'name': 'my-project-dev',
+             'createdDate': datetime.datetime(2018, 2, 1)},
+        ]})
+        stub.add_response('get_stages', {'item': []}, {'restApiId': 'new'})
+        stub.add_response('get_stages', {'item': [{'stageName': 'dev'}]},
+                          {'restApiId': 'old'})
+        self.assertEqual(get_lambda_host('my_project', session),
+                         'old.execute-api.us-east-1.amazonaws.com')
+        stub.assert_no_pending_responses()
+
+    def testRunBootstrap(self):
+        """Test bootstrap commands run in order in one invocation."""
+        def invoke(**kwargs):
+            """Run the raw command the way the Zappa handler does."""
+            management = mock.Mock()
+            management.call_command.side_effect = [None, ValueError('bad')]
+            modules = {
+                'django': mock.Mock(),
+                'django.core': mock.Mock(management=management),
+                'django.core.management': management,
+            }
+            stdout = io.StringIO()
+            with mock.patch.dict(sys.modules, modules), \
+                    mock.patch('sys.stdout', stdout):
+                exec(json.loads(kwargs['Payload'])['raw_command'], {})
+            log = base64.b64encode(stdout.getvalue().encode('utf-8'))
+            return {'LogResult': log.decode('utf-8')}
+
+        session = mock.Mock()
+        client_invoke = session.client.return_value.invoke
+        client_invoke.side_effect = invoke
+        results = run_bootstrap(session, 'my-project-dev', [
+            ('manage', 'migrate'),
+            ('python', 'print("hello")'),
+            ('manage', 'check'),
+            ('manage', 'never'),
+        ])
+        client_invoke.assert_called_once()
+        self.assertEqual([result['ok'] for result in results],
+                         [True, True, False])
+        self.assertEqual(results[1]['output'], 'hello\n')
+        self.assertEqual(results[2]['error'], 'ValueError: bad')
+
+    def testPrunePackage(self):
+        """Test the package analysis and generated exclude settings."""
+        files = {
+            'django/__init__.py': 100,
+            'django/conf/locale/de/LC_MESSAGES/django.po': 50,
+            'numpy/core/tests/test_core.py': 200,
+            'numpy/__pycache__/core.cpython-36.pyc': 30,
+            'numpy-1.15.2.dist-info/RECORD': 10,
+            'botocore/data/endpoints.json': 500,
+        }
+        with temporary_directory():
+            site_packages = 've/lib/python3.6/site-packages/'
+            for name, size in files.items():
+                os.makedirs(os.path.dirname(site_packages + name),
+                            exist_ok=True)
+                with open(site_packages + name, 'w') as file:
+                    file.write('x' * size)
+            with open('zappa_settings.json', 'w') as file:
+                json.dump({'dev': {}, 'prod': {'exclude': ['*.gz']}}, file)
+            report = prune_package()
+            with open('zappa_settings.json') as file:
+                zappa = json.load(file)
+        self.assertEqual(report['total'], 890)
+        self.assertEqual(report['excluded'], 750)
+        self.assertEqual(report['packages'],
+                         {'django': 150, 'numpy': 240, 'botocore': 500})
+        self.assertEqual(report['categories']['tests'], 200)
+        self.assertEqual(report['categories']['__pycache__'], 30)
+        self.assertNotIn('__pycache__', zappa['dev']['exclude'])
+        self.assertIn('tests', zappa['dev']['exclude'])
+        self.assertIn('botocore', zappa['dev']['exclude'])
+        self.assertEqual(zappa['prod']['exclude'][0], '*.gz')
+        self.assertIn('tests', zappa['prod']['exclude'])
+        self.assertFalse(zappa['dev']['slim_handler'])
+        # Zappa matches the patterns against the name at every level.
+        ignore = shutil.ignore_patterns(*zappa['dev']['exclude'])
+        for path in ('django/db/backends/postgresql/base.py',
+                     'django/__pycache__/apps.cpython-36.pyc',
+                     'psycopg2/__init__.py'):
+            parts = path.split('/')
+            for index, part in enumerate(parts):
+                self.assertFalse(
+                    ignore('/'.join(parts[:index]), [part]), path)
+
+    def testDefaultCommand(self):
+        """Test a project name without a command runs deploy."""
+        result = CliRunner().invoke(setup.cli, ['my_project', '--help'])
+        self.assertIn('--buildall', result.output)
+        result = CliRunner().invoke(setup.cli, ['importtime', '--help'])
+        self.assertIn('--threshold', result.output)
+
+    def testImportTime(self):
+        """Test import time parsing and regression detection."""
+        output = '\n'.join([
+            'import time: self [us] | cumulative | imported package',
+            'import time:       100 |        100 |     numpy.core',
+            'import time:       200 |        300 |   numpy',
+            'Some warning',
+            'import time:      1000 |       1300 | project.settings',
+            'import time:      5000 |       5000 | rest_framework',
+        ])
+        tree = setup.parse_importtime(output)
+        self.assertEqual([node['name'] for node in tree],
+                         ['project.settings', 'rest_framework'])
+        self.assertEqual(tree[0]['children'][0]['children'][0]['name'],
+                         'numpy.core')
+        packages = setup.importtime_by_package(tree)
+        self.assertEqual(packages, {
+            'project': 1000, 'numpy': 300, 'rest_framework': 5000})
+        self.assertEqual(
+            [(node['name'], depth)
+             for node, depth in setup.rank_importtime(tree, 3)],
+            [('rest_framework', 0), ('project.settings', 0), ('numpy', 1)])
+
+        before = {'total': 6300, 'packages': dict(packages)}
+        after = {'total': 8500, 'packages': dict(packages, numpy=2500)}
+        self.assertEqual(setup.importtime_regressions(before, after, 10), [
+            ('total', 6300, 8500), ('numpy', 300, 2500)])
+
+    def testStageProfile(self):
+        """Test stage profiles are validated and rendered."""
+        session = boto3.Session()
+        role_info = {
+            'role_name': 'role_name',
+            'subnet_ids': [],
+            'security_group': 'sg'
+        }
+        capacity = setup.stage_profile('prod', memory_size=2048,
+                                       keep_warm_interval=None)
+        self.assertEqual(capacity['memory_size'], 2048)
+        self.assertEqual(capacity['keep_warm_interval'], 3)
+        with temporary_directory():
+            zappa = create_zappa_settings('project_name', role_info, session,
+                                          'bucket', 'prod', capacity)
+        self.assertEqual(zappa['prod']['memory_size'], 2048)
+        self.assertEqual(zappa['prod']['keep_warm_expression'],
+                         'rate(3 minutes)')
+
+        with self.assertRaises(click.BadParameter):
+            setup.stage_profile('dev', memory_size=64)
+        with self.assertRaises(click.BadParameter):
+            setup.stage_profile('dev', reserved_concurrency=0)
+
+    def testTuneMemory(self):
+        """Test memory tuning summarizes and recommends a memory size."""
+        log = base64.b64encode(b'REPORT Billed Duration: 200 ms').decode()
+        client = mock.Mock()
+        client.invoke.return_value = {
+            'Payload': io.BytesIO(b'{}'), 'LogResult': log}
+        samples = setup.benchmark_lambda(
+            client, 'my-project-dev', [{'path': '/'}], 3)
+        self.assertEqual(client.invoke.call_count, 4)
+        self.assertEqual([billed for latency, billed in samples],
+                         [200, 200, 200])
+
+        latencies = {256: 900, 512: 420, 1024: 400, 2048: 390}
+        results = setup.tune_memory(
+            [256, 512, 1024, 2048],
+            lambda memory_size: [(latencies[memory_size], 400)] * 10
+        )
+        self.assertEqual(results[1]['p90'], 420)
+        self.assertAlmostEqual(results[1]['gb_seconds'], 0.2)
+        self.assertEqual(setup.recommend_memory(results, 10), 512)
+        self.assertEqual(setup.recommend_memory(results, 1), 2048)
+
+    def testRunBatch(self):
+        """Test batch projects run concurrently and report their status."""
+        def launch(project):
+            time.sleep(0.2)
+            return 1 if project['project_name'] == 'b' else 0
+
+        start = time.monotonic()
+        results = setup.run_batch(
+            [{'project_name': name} for name in 'abc'], 3, launch)
+        self.assertLess(time.monotonic() - start, 0.4)
+        self.assertEqual([result['ok'] for result in results],
+                         [True, False, True])
+        self.assertGreaterEqual(results[0]['seconds'], 0.2)
+
+    def testBatchComposeEnvironment(self):
+        """Test batch projects publish their Docker services apart."""
+        environments = [setup.compose_environment(name, number)
+                        for number, name in enumerate(['Acme', 'Beta'])]
+        self.assertEqual(environments[0]['COMPOSE_PROJECT_NAME'], 'acme')
+        ports = [environment[variable] for environment in environments
+                 for variable, port in setup.COMPOSE_PORTS]
+        self.assertEqual(len(set(ports)), len(ports))
+
+        published = []
+        for path in ['docker-compose.yml'] + list(
+                setup.COMPOSE_SERVICES.values()):
+            with open(path) as file:
+                published.extend(re.findall(
+                    r'- "\$\{(\w+):-(\d+)\}:\d+"', file.read()))
+        self.assertEqual(
+            sorted(published),
+            sorted((variable, str(port))
+                   for variable, port in setup.COMPOSE_PORTS))
+
+    @mock.patch('setup.wait_for_postgres')
+    @mock.patch('setup.run_subprocess')
+    def testStartProjectComposeFailure(self, run_subprocess, wait):
+        """Test a failing docker-compose command stops start_project."""
+        run_subprocess.side_effect = lambda args, **kwargs: mock.Mock(
+            returncode=1 if 'migrate' in args else 0)
+        with temporary_directory():
+            with open('.env', 'w') as file:
+                file.write('DB_HOST_PORT=20000\n')
+            with self.assertRaises(SystemExit):
+                setup.start_project('my_project', mock.Mock(), 'admin',
+                                    'admin@example.com', 'secret', 'template')
+        wait.assert_called_once_with(port=20000)
+
+    def testRateLimit(self):
+        """Test AWS API calls are spaced out by the rate limit."""
+        session = boto3.Session(region_name='us-east-1',
+                                aws_access_key_id='key',
+                                aws_secret_access_key='secret')
+        setup.rate_limit(session, 20)
+        client = session.client('cloudformation')
+        with Stubber(client) as stubber:
+            for i in range(4):
+                stubber.add_response('list_stacks', {'StackSummaries': []})
+            start = time.monotonic()
+            for i in range(4):
+                client.list_stacks()
+        self.assertGreaterEqual(time.monotonic() - start, 0.15)
+
+    def testAvailabilityZones(self):
+        """Test subnets follow the availability zones of the region."""
+        session = StubSession()
+        session.region_name = 'eu-west-1'
+        session.stub('ec2').add_response(
+            'describe_availability_zones',
+            {'AvailabilityZones': [
+                {'ZoneName': 'eu-west-1c'},
+                {'ZoneName': 'eu-west-1a'},
+                {'ZoneName': 'eu-west-1b'},
+            ]},
+            {'Filters': [
+                {'Name': 'state', 'Values': ['available']},
+                {'Name': 'zone-type', 'Values': ['availability-zone']},
+            ]}
+        )
+        zones = setup.availability_zones(session, 3)
+        self.assertEqual(zones, ['eu-west-1a', 'eu-west-1b', 'eu-west-1c'])
+
+        template = json.loads(setup.role_template(
+            'my_project', zones, name_suffix='-eu-west-1').to_json())
+        resources = template['Resources']
+        subnet = resources['ZappaSubnet3MyProject']['Properties']
+        self.assertEqual(subnet['AvailabilityZone'], 'eu-west-1c')
+        self.assertEqual(subnet['CidrBlock'], '172.31.32.0/20')
+        self.assertEqual(len([key for key in template['Outputs']
+                              if key.startswith('SubnetId')]), 3)
+        self.assertEqual(
+            resources['ZappaRoleMyProject']['Properties']['RoleName'],
+            'ZappaRoleMyProject-eu-west-1')
+        self.assertEqual(setup.region_stage_name('dev', 'eu-west-1'),
+                         'dev_eu_west_1')
+
+    def testRoleTemplateEndpoints(self):
+        """Test the VPC routes S3 through a gateway endpoint."""
+        zones = ['us-east-1a', 'us-east-1b']
+        template = json.loads(setup.role_template(
+            'my_project', zones).to_json())
+        resources = template['Resources']
+        endpoint = resources['ZappaS3EndpointMyProject']['Properties']
+        self.assertEqual(endpoint['VpcEndpointType'], 'Gateway')
+        self.assertEqual(endpoint['RouteTableIds'],
+                         [{'Ref': 'ZappaRouteTableMyProject'}])
+        association = resources['ZappaSubnet2RouteTableMyProject']
+        self.assertEqual(association['Properties']['SubnetId'],
+                         {'Ref': 'ZappaSubnet2MyProject'})
+        self.assertNotIn('MyProjectHttpsIngress', resources)
+
+        template = json.loads(setup.role_template(
+            'my_project', zones, ['lambda', 'sqs']).to_json())
+        resources = template['Resources']
+        endpoint = resources['ZappaSqsEndpointMyProject']['Properties']
+        self.assertEqual(endpoint['VpcEndpointType'], 'Interface')
+        self.assertTrue(endpoint['PrivateDnsEnabled'])
+        self.assertEqual(len(endpoint['SubnetIds']), 2)
+        self.assertIn('MyProjectHttpsIngress', resources)
+        self.assertTrue(resources['VPCMyProject']['Properties'][
+            'EnableDnsHostnames'])
+
+    def testRdsTemplatePooling(self):
+        """Test the RDS template gains an RDS Proxy with pooling."""
+        template = json.loads(setup.rds_template(
+            'my_project', ROLE_INFO, 'password').to_json())
+        self.assertEqual(list(template['Outputs']), ['AwsRdsHost'])
+
+        template = json.loads(setup.rds_template(
+            'my_project', ROLE_INFO, 'password', True).to_json())
+        resources = template['Resources']
+        proxy = resources['MyProjectZappaDBProxy']['Properties']
+        self.assertEqual(proxy['EngineFamily'], 'POSTGRESQL')
+        self.assertEqual(proxy['VpcSubnetIds'], ['subnet-1', 'subnet-2'])
+        self.assertEqual(proxy['Auth'][0]['SecretArn'],
+                         {'Ref': 'MyProjectZappaDBSecret'})
+        targets = resources['MyProjectZappaDBProxyTargets']['Properties']
+        self.assertEqual(targets['DBInstanceIdentifiers'],
+                         [{'Ref': 'MyProjectZappa'}])
+        self.assertIn('AwsRdsProxyHost', template['Outputs'])
+
+    def testRdsTemplateSizing(self):
+        """Test the RDS instance and parameters follow the profile."""
+        capacity = setup.stage_profile(
+            'prod', db_storage_type='io1', db_iops=3000)
+        template = json.loads(setup.rds_template(
+            'my_project', ROLE_INFO, 'password', capacity=capacity).to_json())
+        resources = template['Resources']
+        self.assertEqual(resources['MyProjectZappa']['DeletionPolicy'],
+                         'Delete')
+        instance = resources['MyProjectZappa']['Properties']
+        self.assertEqual(instance['DBInstanceClass'], 'db.m5.large')
+        self.assertEqual(instance['AllocatedStorage'], '100')
+        self.assertEqual(instance['Iops'], 3000)
+        self.assertTrue(instance['MultiAZ'])
+        self.assertEqual(instance['DBParameterGroupName'],
+                         {'Ref': 'ZappaDBParameterGroupMyProject'})
+        group = resources['ZappaDBParameterGroupMyProject']['Properties']
+        self.assertEqual(group['Family'], 'postgres10')
+        self.assertEqual(group['Parameters'], {
+            'max_connections': '901',
+            'shared_buffers': '262144',
+            'effective_cache_size': '786432',
+            'work_mem': '4096',
+        })
+
+        with self.assertRaises(click.BadParameter):
+            setup.stage_profile('dev', db_iops=1000)
+        with self.assertRaises(click.BadParameter):
+            setup.stage_profile('dev', db_engine_version='latest')
+
+    def testRdsTemplateReplicas(self):
+        """Test read replicas are added and their hosts exported."""
+        capacity = setup.stage_profile('dev', db_read_replicas=2)
+        template = json.loads(setup.rds_template(
+            'my_project', ROLE_INFO, 'password', capacity=capacity).to_json())
+        replica = template['Resources']['MyProjectZappaReplica2']
+        self.assertEqual(replica['Properties']['SourceDBInstanceIdentifier'],
+                         {'Ref': 'MyProjectZappa'})
+        hosts = template['Outputs']['AwsRdsReplicaHosts']['Value']
+        self.assertEqual(len(hosts['Fn::Join'][1]), 2)
+
+        with temporary_directory():
+            os.makedirs('my_project/settings')
+            open('my_project/settings/__init__.py', 'w').close()
+            setup.write_settings_components(
+                'my_project',
+                {'replicas': setup.settings_template('replicas')},
+                {'db_router': setup.settings_template('db_router')}
+            )
+            with open('my_project/settings/components/'
+                      'zappa_replicas.py') as file:
+                code = file.read()
+            self.assertTrue(os.path.exists('my_project/db_router.py'))
+
+        environment = {'DB_REPLICA_HOSTS': 'replica-1,replica-2'}
+        decouple = mock.Mock(config=lambda name, default=None, cast=str:
+                             cast(environment.get(name, default)))
+        scope = {
+            '__name__': 'my_project.settings',
+            'DATABASES': {'default': {'HOST': 'db'}},
+            'MIDDLEWARE': ['django.middleware.common.CommonMiddleware'],
+        }
+        with mock.patch.dict(sys.modules, {'decouple': decouple}):
+            exec(code, scope)
+        self.assertEqual(scope['DATABASES']['replica2']['HOST'], 'replica-2')
+        self.assertEqual(scope['DATABASE_ROUTERS'],
+                         ['my_project.db_router.ReplicaRouter'])
+        self.assertEqual(scope['MIDDLEWARE'][0],
+                         'my_project.db_router.ReplicaPinMiddleware')
+
+    def testRdsTemplateCloudFront(self):
+        """Test the bucket is served through CloudFront with --cdn."""
+        template = json.loads(setup.rds_template(
+            'my_project', ROLE_INFO, 'password', cdn=True).to_json())
+        resources = template['Resources']
+        config = resources['MyProjectZappaDistribution']['Properties'][
+            'DistributionConfig']
+        origin = config['Origins'][0]
+        self.assertEqual(origin['DomainName'],
+                         {'Fn::GetAtt': ['MyProjectS3Zappa',
+                                         'RegionalDomainName']})
+        self.assertIn({'Ref': 'MyProjectZappaOriginAccessIdentity'},
+                      origin['S3OriginConfig']['OriginAccessIdentity'][
+                          'Fn::Join'][1])
+        behavior = config['DefaultCacheBehavior']
+        self.assertTrue(behavior['Compress'])
+        self.assertEqual(behavior['MaxTTL'], 31536000)
+        self.assertIn('MyProjectS3ZappaPolicy', resources)
+        self.assertIn('AwsCloudFrontDomain', template['Outputs'])
+
+    def testRdsTemplateRedis(self):
+        """Test a Redis cluster is added to the VPC with --cache."""
+        capacity = setup.stage_profile('staging')
+        template = json.loads(setup.rds_template(
+            'my_project', ROLE_INFO, 'password', capacity=capacity,
+            cache=True).to_json())
+        resources = template['Resources']
+        cluster = resources['MyProjectZappaRedis']['Properties']
+        self.assertEqual(cluster['CacheNodeType'], 'cache.t3.small')
+        self.assertEqual(cluster['VpcSecurityGroupIds'], ['sg'])
+        self.assertEqual(
+            resources['ZappaCacheSubnetGroupMyProject']['Properties'][
+                'SubnetIds'], ['subnet-1', 'subnet-2'])
+        self.assertNotIn('MyProjectRedisIngress', resources)
+        self.assertIn('AwsRedisHost', template['Outputs'])
+
+        template = json.loads(setup.role_template(
+            'my_project', ['us-east-1a', 'us-east-1b']).to_json())
+        ingress = template['Resources']['MyProjectRedisIngress']['Properties']
+        self.assertEqual(ingress['FromPort'], '6379')
+        self.assertEqual(ingress['SourceSecurityGroupId'],
+                         {'Ref': 'ZappaSGMyProject'})
+
+    def testSyncStatic(self):
+        """Test only new and changed static files are uploaded."""
+        s3 = FakeS3()
+        with temporary_directory():
+            os.makedirs('static/css')
+            with open('static/css/app.css', 'w') as file:
+                file.write('body {}')
+            with open('static/css/app.0123456789ab.css', 'w') as file:
+                file.write('body {}')
+            with open('static/staticfiles.json', 'w') as file:
+                json.dump({'paths': {
+                    'css/app.css': 'css/app.0123456789ab.css'}}, file)
+
+            report = setup.sync_static(s3, 'bucket', 'static', 'static/')
+            self.assertEqual(report['uploaded'], 3)
+            hashed = s3.objects['bucket', 'static/css/app.0123456789ab.css']
+            self.assertIn('immutable', hashed['CacheControl'])
+            self.assertEqual(hashed['ContentType'], 'text/css')
+
+            with open('static/css/app.css', 'w') as file:
+                file.write('body { margin: 0 }')
+            report = setup.sync_static(s3, 'bucket', 'static', 'static/')
+            self.assertEqual(report['uploaded'], 1)
+            self.assertEqual(report['skipped'], 2)
+            self.assertEqual(report['uploaded_bytes'], 18)
+
+    def testWriteSettingsComponents(self):
+        """Test generated settings are included once in the project."""
+        with temporary_directory():
+            os.makedirs('my_project/settings/components')
+            with open('my_project/settings/__init__.py', 'w') as file:
+                file.write("include('components/base.py')\n")
+            for i in range(2):
+                setup.write_settings_components(
+                    'my_project',
+                    {'pooling': setup.settings_template('pooling')})
+            with open('my_project/settings/__init__.py') as file:
+                init = file.read()
+            self.assertEqual(
+                init.count("include('components/zappa_pooling.py')"), 1)
+            self.assertTrue(os.path.exists(
+                'my_project/settings/components/zappa_pooling.py'))
+
+        for path in setup.SETTINGS_TEMPLATES.glob('zappa_*.py'):
+            compile(path.read_text(), str(path), 'exec')
+
+        self.assertEqual(setup.compose_files(['cdn']), 'docker-compose.yml')
+        self.assertEqual(
+            setup.compose_files(['replicas', 'cache']).split(os.pathsep),
+            ['docker-compose.yml', 'docker/compose-cache.yml',
+             'docker/compose-replicas.yml'])
+
+    def testEmptyBucket(self):
+        """Test buckets are emptied with a request per 1000 keys."""
+        session = mock.Mock()
+        client = session.client.return_value
+        keys = ['static/{}.css'.format(i) for i in range(1003)]
+        client.get_paginator.return_value.paginate.return_value = [
+            {'Contents': [{'Key': key} for key in keys[:1000]]},
+            {'Contents': [{'Key': key} for key in keys[1000:]]},
+        ]
+        client.delete_objects.return_value = {}
+        self.assertEqual(setup.empty_bucket(session, 'bucket'), 1003)
+        client.get_paginator.assert_called_once_with('list_objects_v2')
+        client.get_paginator.return_value.paginate.assert_called_once_with(
+            Bucket='bucket', PaginationConfig={'PageSize': 1000})
+        batches = sorted(
+            [item['Key'] for item in call[1]['Delete']['Objects']]
+            for call in client.delete_objects.call_args_list)
+        self.assertEqual(sorted(sum(batches, [])), sorted(keys))
+        self.assertEqual(sorted(len(batch) for batch in batches), [3, 1000])
+
+        client.delete_objects.return_value = {'Errors': [
+            {'Key': keys[0], 'Code': 'AccessDenied', 'Message': 'Denied'}]}
+        with self.assertRaises(SystemExit):
+            setup.empty_bucket(session, 'bucket')
+
+    @mock.patch('setup.sleep')
+    def testDeleteStack(self, sleep):
+        """Test stack deletion waits by id and skips the old events."""
+        session = StubSession()
+        stub = session.stub('cloudformation')
+        stack = stack_description('CREATE_COMPLETE')
+        stack['Stacks'][0]['StackId'] = 'stack-id'
+        stub.add_response('describe_stacks', stack, {'StackName': 'stack'})
+        stub.add_response('describe_stack_events', {'StackEvents': [
+            stack_event('1', 'DB', 'CREATE_COMPLETE', 0),
+        ]})
+        stub.add_response('delete_stack', {}, {'StackName': 'stack-id'})
+        stub.add_response('describe_stacks',
+                          stack_description('DELETE_COMPLETE'),
+                          {'StackName': 'stack-id'})
+        stub.add_response('describe_stack_events', {'StackEvents': [
+            stack_event('3', 'DB', 'DELETE_COMPLETE', 9),
+            stack_event('2', 'DB', 'DELETE_IN_PROGRESS', 1),
+            stack_event('1', 'DB', 'CREATE_COMPLETE', 0),
+        ]})
+        with mock.patch('setup.click.echo') as echo:
+            setup.delete_stack('stack', session, 'test')
+        stub.assert_no_pending_responses()
+        printed = ' '.join(str(call[0][0]) for call in echo.call_args_list)
+        self.assertIn('DELETE_COMPLETE (8m00s)', printed)
+        self.assertNotIn('CREATE_COMPLETE', printed)
+        sleep.assert_not_called()
+
+        stub.add_client_error(
+            'describe_stacks', 'ValidationError',
+            'Stack with id stack does not exist')
+        self.assertIsNone(setup.delete_stack('stack', session, 'test'))
+
+    @mock.patch('setup.run_pipeline')
+    @mock.patch('setup.docker')
+    @mock.patch('setup.boto3.Session')
+    @mock.patch('setup.create_boto_session')
+    def testDestroyProfileRegion(self, create_boto_session, Session, docker,
+                                 run_pipeline):
+        """Test destroy finds the region of settings without aws_region."""
+        create_boto_session.return_value = mock.Mock(
+            profile_name='default', region_name='us-east-1')
+        with temporary_directory():
+            with open('zappa_settings.json', 'w') as file:
+                json.dump({'dev': {
+                    'project_name': 'acme',
+                    'profile_name': 'default',
+                    'profile-region': 'eu-west-1',
+                    's3_bucket': 'zappa-abcdefghi',
+                }}, file)
+            result = CliRunner().invoke(setup.cli, ['destroy', 'acme',
+                                                    '--yes'])
+            with open('zappa_settings.json') as file:
+                zappa = json.load(file)
+        self.assertEqual(result.exit_code, 0, result.output)
+        Session.assert_called_once_with(profile_name='default',
+                                        region_name='eu-west-1')
+        steps = [step[0] for step in run_pipeline.call_args[0][0]]
+        self.assertIn('undeploy@dev', steps)
+        self.assertIn('role_stack@eu-west-1', steps)
+        self.assertEqual(zappa, {})
+
+    @mock.patch('setup.delete_stack')
+    @mock.patch('setup.stack_buckets', return_value=['customers-static'])
+    @mock.patch('setup.empty_bucket')
+    @mock.patch('setup.run_subprocess')
+    @mock.patch('setup.create_boto_session')
+    def testDestroyBatch(self, create_boto_session, run_subprocess,
+                         empty_bucket, stack_buckets, delete_stack):
+        """Test the shared stacks go once every project is destroyed."""
+        session = create_boto_session.return_value
+        session.profile_name = 'default'
+        manifest = {'name': 'customers', 'projects': [
+            {'directory': 'acme', 'project_name': 'acme'},
+            {'directory': 'globex', 'project_name': 'globex'},
+        ]}
+        with temporary_directory():
+            for project in manifest['projects']:
+                os.mkdir(project['directory'])
+            with open('projects.json', 'w') as file:
+                json.dump(manifest, file)
+
+            run_subprocess.return_value = mock.Mock(returncode=1)
+            result = CliRunner().invoke(
+                setup.cli, ['destroy-batch', 'projects.json', '--yes'])
+            self.assertEqual(result.exit_code, 1, result.output)
+            delete_stack.assert_not_called()
+
+            run_subprocess.return_value = mock.Mock(returncode=0)
+            result = CliRunner().invoke(
+                setup.cli, ['destroy-batch', 'projects.json', '--yes'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        command = run_subprocess.call_args[0][0]
+        self.assertEqual(command[2:4], ['destroy', 'globex'])
+        self.assertIn('--if-exists', command)
+        empty_bucket.assert_called_once_with(session, 'customers-static')
+        self.assertEqual(
+            [call[0][0] for call in delete_stack.call_args_list],
+            ['Customers-Zappa-RDS-S3', 'Customers-Zappa-Role-VPC-SG'])
+
+        with temporary_directory():
+            result = CliRunner().invoke(
+                setup.cli, ['destroy', 'acme', '--yes', '--if-exists'])
+        self.assertEqual(result.exit_code, 0, result.output)
+
 
 if __name__ == '__main__':
     unittest.main()